@@ -1,7 +1,8 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import (Pull, RawJson, Course, CourseSection, User, Enrollment)
+from .models import (Pull, PullProgress, RawJson, RawJsonBlob, Course,
+                     CourseSection, User, Enrollment, CourseSummary)
 
 
 
@@ -12,11 +13,22 @@ class PullAdmin(admin.ModelAdmin):
 
 admin.site.register(Pull, PullAdmin)
 
+class PullProgressAdmin(admin.ModelAdmin):
+    list_display = ("pull", "endpoint", "course_id", "done", "updated_at")
+    list_filter = ("endpoint", "done")
+
+admin.site.register(PullProgress, PullProgressAdmin)
+
 class RawJsonAdmin(admin.ModelAdmin):
-    list_display = ("id", "api_id", "model", "pull",)
+    list_display = ("id", "api_id", "model", "pull", "blob")
 
 admin.site.register(RawJson, RawJsonAdmin)
 
+class RawJsonBlobAdmin(admin.ModelAdmin):
+    list_display = ("hash",)
+
+admin.site.register(RawJsonBlob, RawJsonBlobAdmin)
+
 class CourseAdmin(admin.ModelAdmin):
     date_hierarchy = "start_at"
     ordering = ["-start_at"]
@@ -47,3 +59,9 @@ class EnrollmentAdmin(admin.ModelAdmin):
                     "course_section", "enrollment_state", "role")
 
 admin.site.register(Enrollment, EnrollmentAdmin)
+
+class CourseSummaryAdmin(admin.ModelAdmin):
+    list_display = ("course", "students", "teachers", "enrollments",
+                    "last_activity_at", "updated_at")
+
+admin.site.register(CourseSummary, CourseSummaryAdmin)
@@ -0,0 +1,114 @@
+"""cpu time the ingest spends on json and timestamps, per codec
+
+synthetic enrollment pages (lib.synthetic) are encoded like canvas
+sends them, then for every codec in lib.codec this measures the cpu
+time (time.process_time, the best of --repeat runs) of what the sync
+does to each object outside the database:
+
+    decode pages     lib.codec.loads of every page, in lib.canvas
+    content hashes   canonical_json + sha256 of every object, in RawJsonWriter
+    timestamps       turning the enrollment and user timestamps into
+                     datetimes; the standard library row hands django
+                     the strings to parse, the others parse them first
+                     with lib.codec.parse_datetime
+
+and reports it per 10k enrollments, with what each codec saves over
+the standard library.
+
+    manage.py benchmark_codec --enrollments 50000
+
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import models
+
+from canvas.models import content_hash
+import lib.codec
+import lib.synthetic
+
+per = 10000
+timestamp_paths = [(), ("user",)]
+timestamp_fields = ("created_at", "updated_at", "last_activity_at",
+                    "last_attended_at")
+
+
+def pages_of(enrollments, per_course=100):
+    """ the encoded pages of about `enrollments` synthetic enrollments """
+    canvas = lib.synthetic.SyntheticCanvas(
+        courses=max(1, enrollments // per_course), sections_per_course=1,
+        enrollments_per_course=per_course)
+    return [lib.codec.JsonCodec().dumps(page).encode("utf-8")
+            for course_id in map(canvas.course_id, range(canvas.courses))
+            for page, _ in canvas.iter_course_enrollments(course_id)]
+
+
+def timestamps(objs):
+    for obj in objs:
+        for path in timestamp_paths:
+            fields = obj
+            for key in path:
+                fields = fields[key]
+            for name in timestamp_fields:
+                if name in fields:
+                    yield fields[name]
+
+
+def cpu_ms(work, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        work()
+        elapsed = (time.process_time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(codec, pages, repeat):
+    """ {phase: cpu ms} for one codec """
+    objs = [obj for page in pages for obj in codec.loads(page)]
+    values = list(timestamps(objs))
+    to_python = models.DateTimeField().to_python
+    if codec.name == "json":
+        parse = to_python
+    else:
+        def parse(value):
+            return to_python(lib.codec.parse_datetime(value))
+    return {
+        "decode pages": cpu_ms(lambda: [codec.loads(page) for page in pages],
+                               repeat),
+        "content hashes": cpu_ms(
+            lambda: [content_hash(codec.canonical(obj)) for obj in objs], repeat),
+        "timestamps": cpu_ms(lambda: [parse(value) for value in values], repeat),
+    }, len(objs)
+
+
+class Command(BaseCommand):
+
+    help = "benchmarks json decoding, content hashing and timestamp parsing"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--enrollments", type=int, default=per)
+        parser.add_argument(
+            "--repeat", type=int, default=5,
+            help="runs of each phase, the fastest is reported")
+
+    def handle(self, *args, **options):
+        pages = pages_of(options['enrollments'])
+        results = {}
+        for name in lib.codec.codecs:
+            results[name], count = measure(lib.codec.get_codec(name), pages,
+                                           options['repeat'])
+        scale = per / count
+        names = list(results)
+        print(f"cpu ms per {per} enrollments ({count} measured, "
+              f"{sum(map(len, pages)) // 1024} KiB of pages)")
+        print(f"{'phase':<16}" + "".join(f"{name:>10}" for name in names)
+              + "".join(f"{'saved':>10}" for _ in names[1:]))
+        for phase in results["json"]:
+            row = [results[name][phase] * scale for name in names]
+            print(f"{phase:<16}" + "".join(f"{ms:>10.1f}" for ms in row)
+                  + "".join(f"{row[0] - ms:>10.1f}" for ms in row[1:]))
+        totals = [sum(results[name].values()) * scale for name in names]
+        print(f"{'total':<16}" + "".join(f"{ms:>10.1f}" for ms in totals)
+              + "".join(f"{totals[0] - ms:>10.1f}" for ms in totals[1:]))
@@ -0,0 +1,125 @@
+"""query plans and timings of the hot read paths, with and without the
+indexes declared in Meta.indexes
+
+synthetic canvas data (lib.synthetic) is synced into the default
+database, then each query below is explained and timed once with the
+Meta.indexes of the canvas models dropped and once with them created
+again.  everything happens in one transaction that is rolled back, so
+the database is left as it was.
+
+    manage.py benchmark_queries --courses 2000 --enrollments-per-course 50
+
+"""
+import statistics
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from canvas.models import Pull, RawJson, Course, Enrollment
+from canvas.views import course_api_ordering
+from canvas.management.commands import sync_canvas_data
+from canvas.management.commands.benchmark_sync import stages
+import lib.logs
+import lib.synthetic
+
+
+def hot_queries(pull):
+    """ (name, queryset) for the queries the indexes are meant for
+
+    two hot paths are left out on purpose, since no declared index is
+    for them: a course's roster is sorted on the joined user's
+    sortable_name, which no index on Enrollment can give in order, and
+    the existing enrollments of a batch are found through the course
+    foreign key and the (user, course, type) unique indexes django
+    makes anyway """
+    return [
+        ("course list", Course.objects.order_by("-start_at")[:100]),
+        ("courses-json page", Course.objects.order_by(
+            *course_api_ordering).values()[:101]),
+        ("staged enrollment batch", RawJson.objects.filter(
+            pull=pull, model="Enrollment").order_by("id").values_list(
+                "json", "blob__json")[:500]),
+    ]
+
+
+def declared_indexes():
+    return [(model, index) for model in apps.get_app_config("canvas").get_models()
+            for index in model._meta.indexes]
+
+
+def time_query(queryset, repeat):
+    """ median milliseconds to run the queryset's sql and fetch the rows,
+    leaving out building model instances, which no index changes """
+    sql, params = queryset.query.sql_with_params()
+    times = []
+    with connection.cursor() as cursor:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cursor.execute(sql, params)
+            cursor.fetchall()
+            times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+class Command(BaseCommand):
+
+    help = "explains and times the hot read queries with and without indexes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--courses", type=int, default=1000)
+        parser.add_argument("--sections-per-course", type=int, default=2)
+        parser.add_argument("--enrollments-per-course", type=int, default=30)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--repeat", type=int, default=20,
+            help="times each query is run, the median is reported")
+        parser.add_argument(
+            "--plans", action="store_true",
+            help="print the query plans as well as the timings")
+
+    def handle(self, *args, **options):
+        lib.logs.set_level(lib.logs.verbosity_level(options['verbosity'] - 1),
+                           "lib", "canvas")
+        canvas = lib.synthetic.SyntheticCanvas(
+            courses=options['courses'],
+            sections_per_course=options['sections_per_course'],
+            enrollments_per_course=options['enrollments_per_course'],
+            seed=options['seed'])
+        saved_canvasapi = sync_canvas_data.canvasapi
+        sync_canvas_data.canvasapi = canvas
+        try:
+            with transaction.atomic():
+                self.benchmark(options)
+                transaction.set_rollback(True)
+        finally:
+            sync_canvas_data.canvasapi = saved_canvasapi
+
+    def benchmark(self, options):
+        pull = Pull.objects.create()
+        for _, stage, _ in stages(pull, {}):
+            stage()
+        print(f"Synced {Course.objects.count()} courses, "
+              f"{Enrollment.objects.count()} enrollments into {connection.vendor}")
+        editor = connection.schema_editor()
+        indexes = declared_indexes()
+        results = {}
+        for label in ("without", "with"):
+            with connection.cursor() as cursor:
+                for model, index in indexes:
+                    if label == "without":
+                        cursor.execute(f"DROP INDEX {editor.quote_name(index.name)}")
+                    else:
+                        cursor.execute(str(index.create_sql(model, editor)))
+                cursor.execute("ANALYZE")
+            for name, queryset in hot_queries(pull):
+                if options['plans']:
+                    print(f"\n{name}, {label} indexes:\n{queryset.explain()}")
+                results.setdefault(name, {})[label] = time_query(
+                    queryset, options['repeat'])
+        print(f"\n{'query':<34} {'without ms':>11} {'with ms':>9} {'speedup':>8}")
+        for name, times in results.items():
+            speedup = times["without"] / times["with"] if times["with"] else 0
+            print(f"{name:<34} {times['without']:>11.3f} {times['with']:>9.3f} "
+                  f"{speedup:>7.1f}x")
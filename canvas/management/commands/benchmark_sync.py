@@ -0,0 +1,164 @@
+"""time the stages of sync_canvas_data on synthetic canvas data
+
+each scale given with --courses gets made up courses, sections and
+enrollments from lib.synthetic, which are staged and materialized by
+the same stage functions sync_canvas_data runs.  for every stage the
+wall time, number of sql queries and rows written per second are
+reported, and with --memory the peak python memory (tracemalloc, which
+makes the stages several times slower, so compare times only between
+runs with the same setting).  everything runs in a
+transaction that is rolled back afterwards unless --keep is given, so
+it's safe to point at a database with real data in it.
+
+it benchmarks whatever the default database is; to compare sqlite with
+postgresql run it once more with --settings pointing at a settings
+module whose default database is postgresql.
+
+    manage.py benchmark_sync --courses 100 1000 10000 --enrollments-per-course 100
+
+"""
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from canvas.metrics import PullMetrics
+from canvas.models import (Pull, RawJson, Course, CourseSection, User,
+                           Enrollment, CourseSummary)
+from canvas.management.commands import sync_canvas_data
+import lib.logs
+import lib.synthetic
+
+
+def run_stage(metrics, name, stage, rows, memory=False):
+    """ run stage() as one stage of metrics, returns its record with the
+    rows written (counted with rows()) and, if memory is traced, the
+    peak_mb """
+    before = rows()
+    if memory:
+        tracemalloc.start()
+    try:
+        with metrics.stage(name) as record:
+            stage()
+        if memory:
+            record["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+    finally:
+        if memory:
+            tracemalloc.stop()
+    record["rows"] = rows() - before
+    return record
+
+
+def stages(pull, options):
+    """ (name, stage, rows) for each stage of a pull, in order """
+    def raw(model):
+        return lambda: RawJson.objects.filter(pull=pull, model=model).count()
+    return [
+        ("stage courses",
+         lambda: sync_canvas_data.import_raw_json_courses(pull, **options),
+         raw("Course")),
+        ("stage sections",
+         lambda: sync_canvas_data.import_raw_json_sections(pull, **options),
+         raw("CourseSection")),
+        ("stage enrollments",
+         lambda: sync_canvas_data.import_raw_json_enrollments(pull, **options),
+         raw("Enrollment")),
+        ("save courses",
+         lambda: sync_canvas_data.save_courses(pull, **options),
+         Course.objects.count),
+        ("save sections",
+         lambda: sync_canvas_data.save_course_sections(pull, **options),
+         CourseSection.objects.count),
+        ("save users and enrollments",
+         lambda: sync_canvas_data.save_users_and_enrollments(pull, **options),
+         lambda: User.objects.count() + Enrollment.objects.count()),
+        ("save course summaries",
+         lambda: sync_canvas_data.save_course_summaries(pull, **options),
+         CourseSummary.objects.count),
+    ]
+
+
+class Command(BaseCommand):
+
+    help = "benchmarks the sync stages on synthetic canvas data"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--courses", type=int, nargs="+", default=[100],
+            help="number of courses, several numbers benchmark several "
+            "scales (default 100)")
+        parser.add_argument(
+            "--sections-per-course", type=int, default=2)
+        parser.add_argument(
+            "--enrollments-per-course", type=int, default=30)
+        parser.add_argument(
+            "--users", type=int,
+            help="size of the pool enrollments draw users from "
+            "(default a tenth of the enrollments)")
+        parser.add_argument(
+            "--seed", type=int, default=0)
+        parser.add_argument(
+            "--batch-size", type=int, default=sync_canvas_data.default_batch_size)
+        parser.add_argument(
+            "--workers", type=int, default=1)
+        parser.add_argument(
+            "--materialize", choices=["sql", "python"], default="sql",
+            help="how the save stages turn staged json into rows, see "
+            "sync_canvas_data --materialize")
+        parser.add_argument(
+            "--processes", type=int, default=1,
+            help="see sync_canvas_data --processes")
+        parser.add_argument(
+            "--memory", action="store_true",
+            help="also report peak memory per stage (much slower)")
+        parser.add_argument(
+            "--keep", action="store_true",
+            help="commit what was synced instead of rolling it back")
+        parser.add_argument(
+            "--write-archive", metavar="PATH",
+            help="also save the synthetic pages of the (last) scale as an "
+            "archive for sync_canvas_data --replay")
+
+    def handle(self, *args, **options):
+        # the stages log at info level what -v 1 of sync_canvas_data shows,
+        # keep that out of the table unless asked for
+        lib.logs.set_level(lib.logs.verbosity_level(options['verbosity'] - 1),
+                           "lib", "canvas")
+        print(f"Benchmarking on {connection.vendor} "
+              f"({connection.settings_dict['NAME']})")
+        print(f"{'courses':>8} {'stage':<28} {'seconds':>9} {'queries':>8} "
+              f"{'peak MB':>8} {'rows':>9} {'rows/s':>9}")
+        for courses in options['courses']:
+            canvas = lib.synthetic.SyntheticCanvas(
+                courses=courses,
+                sections_per_course=options['sections_per_course'],
+                enrollments_per_course=options['enrollments_per_course'],
+                users=options['users'], seed=options['seed'])
+            self.benchmark(canvas, options)
+        if options['write_archive']:
+            pages = canvas.write_archive(options['write_archive'])
+            print(f"Wrote {pages} pages to {options['write_archive']}")
+
+    def benchmark(self, canvas, options):
+        stage_options = {"batch_size": options['batch_size'],
+                         "workers": options['workers'],
+                         "materialize": options['materialize'],
+                         "processes": options['processes']}
+        saved_canvasapi = sync_canvas_data.canvasapi
+        sync_canvas_data.canvasapi = canvas
+        try:
+            with transaction.atomic():
+                pull = Pull.objects.create()
+                metrics = PullMetrics(canvas.throttle)
+                for name, stage, rows in stages(pull, stage_options):
+                    record = run_stage(metrics, name, stage, rows,
+                                       options['memory'])
+                    seconds = record["seconds"]
+                    rate = record["rows"] / seconds if seconds else 0
+                    print(f"{canvas.courses:>8} {name:<28} {seconds:>9.3f} "
+                          f"{record['queries']:>8} {record.get('peak_mb', '-'):>8} "
+                          f"{record['rows']:>9} {rate:>9.0f}")
+                if not options['keep']:
+                    transaction.set_rollback(True)
+        finally:
+            sync_canvas_data.canvasapi = saved_canvasapi
@@ -0,0 +1,59 @@
+"""move inline RawJson payloads into the shared RawJsonBlob table
+
+rows staged before content hashing existed keep their payload in
+RawJson.json.  this hashes each of them, points the row at the
+matching blob (creating it if it's the first time we see that
+content) and nulls the inline copy, so identical objects from
+different pulls end up stored once.  it also drops blobs no RawJson
+row refers to anymore, e.g. after old pulls were deleted.
+
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from canvas.models import RawJson, RawJsonBlob, canonical_json, content_hash
+
+default_batch_size = 1000
+
+
+def compact_batch(rows):
+    """ point a batch of inline rows at blobs, returns the number of new blobs """
+    blobs = {}
+    for row in rows:
+        row.blob_id = content_hash(canonical_json(row.json))
+        blobs[row.blob_id] = row.json
+        row.json = None
+    existing = set(RawJsonBlob.objects.filter(
+        hash__in=blobs).values_list("hash", flat=True))
+    RawJsonBlob.objects.bulk_create(
+        [RawJsonBlob(hash=h, json=obj) for h, obj in blobs.items()
+         if h not in existing],
+        ignore_conflicts=True)
+    RawJson.objects.bulk_update(rows, ["blob", "json"])
+    return len(blobs) - len(existing)
+
+
+class Command(BaseCommand):
+
+    help = "deduplicates RawJson payloads by content hash"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=default_batch_size,
+            help=f"number of RawJson rows per batch (default {default_batch_size})")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        compacted = 0
+        created = 0
+        while True:
+            with transaction.atomic():
+                rows = list(RawJson.objects.filter(
+                    blob__isnull=True, json__isnull=False).order_by("id")[:batch_size])
+                if not rows:
+                    break
+                created += compact_batch(rows)
+            compacted += len(rows)
+            print(f"Compacted {compacted} RawJson rows into {created} new blobs")
+        orphans, _ = RawJsonBlob.objects.filter(rawjson__isnull=True).delete()
+        print(f"Compacted {compacted} RawJson rows, created {created} blobs, "
+              f"deleted {orphans} unreferenced blobs")
@@ -8,141 +8,659 @@ cf https://canvas.instructure.com/doc/api/file.pagination.html
 cf https://canvas.instructure.com/doc/api/file.throttling.html
 
 """
-import json
-import os
-import requests
+import datetime
+import logging
+import multiprocessing
+import operator
 import sys
-import time
-import dateutil.parser as dp
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from django.core.management.base import BaseCommand, CommandError
-from django.db import connection, reset_queries
-from django.db.utils import IntegrityError
-from canvas.models import (Pull, RawJson, Course, User, Enrollment,
-                           CourseSection)
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.utils import timezone
+from canvas.models import (Pull, PullProgress, RawJson, RawJsonBlob, Course,
+                           User, Enrollment, CourseSection, canonical_json,
+                           content_hash)
 
+from canvas.metrics import PullMetrics
+from canvas import sql_materialize
+from canvas.summaries import changed_course_ids, refresh_course_summaries
 import lib.canvas
+import lib.codec
+import lib.logs
+import lib.materialize
+import lib.replay
+import lib.response_cache
 
-token_env_var = "DJANVAS_TOKEN"
-per_page = 10
-interesting_fields = ['id', "name", "course_code", "workflow_state", "start_at", "uuid", "enrollments"]
-exponential_backoff_start_ms = 1000
-canvasapi = lib.canvas.api()
+default_batch_size = 500
+default_log_sample = 1000
+# an incremental pull looks again at enrollments that changed this long
+# before the previous pull's watermark: canvas timestamps are to the
+# second, so one changed in the same second after that pull read it
+# would otherwise be lost for good
+watermark_margin = datetime.timedelta(minutes=5)
+logger = logging.getLogger(__name__)
+# one message per staged or materialized object, at debug level and
+# sampled down to one in --log-sample
+row_logger = logging.getLogger(f"{__name__}.rows")
+# the lib.canvas record each staged model is materialized from
+record_classes = {"Course": lib.canvas.CourseRecord,
+                  "CourseSection": lib.canvas.SectionRecord,
+                  "Enrollment": lib.canvas.EnrollmentRecord}
+# and the model it's materialized to
+materialized_models = {"Course": Course, "CourseSection": CourseSection,
+                       "Enrollment": Enrollment}
+# built by connect() when the command runs, so importing this module
+# doesn't need a token
+canvasapi = None
+
+
+def connect(**options):
+    """ a canvas api client for one run of the command, serving pages from
+    a --replay archive instead of canvas, or copying them to a --record one """
+    transport = None
+    recorder = None
+    if options.get('replay'):
+        transport = lib.replay.ReplayAdapter(
+            options['replay'], latency_ms=options.get('replay_latency_ms', 0),
+            bucket_size=options.get('replay_bucket_size'))
+    elif options.get('record'):
+        recorder = lib.replay.Recorder(options['record'])
+    try:
+        return lib.canvas.api(transport=transport, recorder=recorder)
+    except RuntimeError as e:
+        raise CommandError(str(e))
 
-def import_raw_json_courses(pull, **options):
-    """ get the raw course info from canvas api """
-    print(f"Running import raw json courses for pull {pull.id}")
-    courses = canvasapi.get_all_courses()
-    print(f"Got {len(courses)} Courses from canvas api")
-    count = 0
-    for course_json in courses:
-        record = RawJson(json=json.dumps(course_json),
-                         model="Course",
-                         api_id=course_json["id"],
-                         pull=pull)
 
+def fetch_per_course(course_ids, iterate, workers=1, pages_per_course=4):
+    """ yields (course_id, page) for every page of every course, in course
+    order, where iterate(course_id) is an iterator of pages
+
+    with workers > 1 the courses are fetched on a thread pool, each into
+    its own queue of at most pages_per_course pages, and at most
+    2*workers courses are in flight at once, so memory stays bounded
+    no matter how slow the earlier courses are
+
+    if the caller stops early (an exception, ctrl-c or closing the
+    generator) the producers give up at their next page, and courses
+    that haven't started are never fetched
+    """
+    if workers <= 1:
+        for course_id in course_ids:
+            for page in iterate(course_id):
+                yield course_id, page
+        return
+    done = object()
+    cancelled = threading.Event()
+
+    def put(pages, item):
+        """ wait for room in pages, False if cancelled first """
+        while not cancelled.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(course_id, pages):
         try:
-            record.save()
-            count += 1
-        except IntegrityError as e:
-            print(f"skipping Course {record.id} for pull {pull.id} {pull}")
+            for page in iterate(course_id):
+                if not put(pages, page):
+                    return
         except Exception as e:
-            raise e
-    print(f"Saved {count} raw json courses")
-
-def import_raw_json_sections(pull, **options):
-    """ get the raw course section info from canvas api """
-
-    print(f"Running import raw json sections for pull {pull.id}")
-    count = 0
-    for raw_json_course in RawJson.objects.filter(pull=pull, model="Course"):
-        course_id = raw_json_course.api_id
-        print(f"Getting sections for Course {course_id}")
-        sections = canvasapi.get_course_sections(course_id)
-        for section  in sections:
-            print(f"saving rawjson for {section}")
-            record = RawJson(json=json.dumps(section),
-                             model="CourseSection",
-                             api_id=section["id"],
-                             pull=pull)
+            put(pages, e)
+            return
+        put(pages, done)
 
+    def drain(course_id, pages):
+        while True:
+            page = pages.get()
+            if page is done:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield course_id, page
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        try:
+            for course_id in course_ids:
+                pages = queue.Queue(maxsize=pages_per_course)
+                executor.submit(produce, course_id, pages)
+                in_flight.append((course_id, pages))
+                if len(in_flight) >= 2 * workers:
+                    yield from drain(*in_flight.popleft())
+            while in_flight:
+                yield from drain(*in_flight.popleft())
+        finally:
+            cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+class RawJsonWriter:
+    """ batched staging writer for the RawJson rows of one pull
+
+    rows are collected with add() and inserted with bulk_create in
+    batches of batch_size, all inside one transaction that is committed
+    when the with block exits.  rows that collide with the
+    unique_together constraint (the same object twice in a pull) are
+    dropped by the database instead of raising IntegrityError, and the
+    counts of inserted vs duplicate rows are available afterwards.
+    payloads go to the shared RawJsonBlob table keyed by content hash,
+    so an object that didn't change since an earlier pull costs one
+    row pointing at the blob that's already there.
+
+        with RawJsonWriter(pull) as writer:
+            for obj in objs:
+                writer.add("Course", obj)
+        print(writer.inserted, writer.duplicates)
+
+    on_flush, if given, is called with the (content hash, json object)
+    pairs of every batch right after it's inserted; the streaming
+    pipeline uses it to materialize a batch while it's still in memory
+
+    with commit_every_batch, each batch is its own transaction instead,
+    together with the PullProgress checkpoints registered (after their
+    page's rows were added) since the previous batch, so a crash loses
+    at most one batch and --resume knows exactly where to restart
+    """
+    def __init__(self, pull, batch_size=default_batch_size, on_flush=None,
+                 commit_every_batch=False):
+        self.pull = pull
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.commit_every_batch = commit_every_batch
+        self.batch = []
+        self.blobs = {}
+        self.objects = []
+        self.checkpoints = {}
+        self.added = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self._atomic = transaction.atomic()
+
+    def _count(self):
+        return RawJson.objects.filter(pull=self.pull).count()
+
+    def __enter__(self):
+        if not self.commit_every_batch:
+            self._atomic.__enter__()
+        self._count_before = self._count()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.commit_every_batch:
+            if exc_type is None:
+                self.flush()
+                self.inserted = self._count() - self._count_before
+                self.duplicates = self.added - self.inserted
+            else:
+                # whatever pages made it in completely are still good,
+                # keep them so a resume doesn't have to fetch them again
+                try:
+                    self.flush()
+                except Exception:
+                    pass
+            return False
+        if exc_type is None:
             try:
-                record.save()
-                count += 1
-            except IntegrityError as e:
-                print(e)
-            except Exception as e:
-                raise e
-    print(f"Saved {count} raw json sections")
-
-def import_raw_json_enrollments(pull, **options):
+                self.flush()
+                self.inserted = self._count() - self._count_before
+                self.duplicates = self.added - self.inserted
+            except Exception:
+                self._atomic.__exit__(*sys.exc_info())
+                raise
+        return self._atomic.__exit__(exc_type, exc_value, traceback)
+
+    def checkpoint(self, course_id, endpoint, next_url):
+        """ record that every page of endpoint before next_url has been
+        added; next_url None means the endpoint is done """
+        self.checkpoints[(course_id, endpoint)] = next_url
+
+    def add(self, model, json_obj):
+        blob_hash = content_hash(canonical_json(json_obj))
+        self.blobs[blob_hash] = json_obj
+        if self.on_flush is not None:
+            self.objects.append((blob_hash, json_obj))
+        self.batch.append(RawJson(blob_id=blob_hash,
+                                  model=model,
+                                  api_id=json_obj["id"],
+                                  pull=self.pull))
+        self.added += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch and not self.checkpoints:
+            return
+        with transaction.atomic():
+            RawJsonBlob.objects.bulk_create(
+                [RawJsonBlob(hash=h, json=obj) for h, obj in self.blobs.items()],
+                ignore_conflicts=True)
+            RawJson.objects.bulk_create(self.batch, ignore_conflicts=True)
+            if self.on_flush is not None and self.objects:
+                self.on_flush(self.objects)
+            PullProgress.objects.bulk_create(
+                [PullProgress(pull=self.pull, course_id=course_id,
+                              endpoint=endpoint, next_url=next_url,
+                              done=next_url is None)
+                 for (course_id, endpoint), next_url in self.checkpoints.items()],
+                update_conflicts=True,
+                unique_fields=["pull", "course_id", "endpoint"],
+                update_fields=["next_url", "done", "updated_at"])
+        self.batch = []
+        self.blobs = {}
+        self.objects = []
+        self.checkpoints = {}
+
+def load_progress(pull, endpoint):
+    """ {course_id: PullProgress} of one endpoint of a pull """
+    return {p.course_id: p for p in PullProgress.objects.filter(
+        pull=pull, endpoint=endpoint)}
+
+def import_raw_json_courses(pull, on_flush=None, **options):
+    """ get the raw course info from canvas api """
+    logger.info("Running import raw json courses for pull %s", pull.id)
+    progress = load_progress(pull, "courses").get(0)
+    if progress and progress.done:
+        logger.info("Courses for pull %s were already staged", pull.id)
+        return 0
+    with RawJsonWriter(pull, options.get('batch_size') or default_batch_size,
+                       on_flush, commit_every_batch=True) as writer:
+        for courses, next_url in canvasapi.iter_all_courses(
+                start_url=progress.next_url if progress else None):
+            logger.debug("Got %s Courses from canvas api", len(courses))
+            for course_json in courses:
+                writer.add("Course", course_json)
+            writer.checkpoint(0, "courses", next_url)
+    logger.info("Saved %s raw json courses, skipped %s duplicates",
+                writer.inserted, writer.duplicates)
+    return writer.inserted
+
+def import_raw_json_sections(pull, on_flush=None, **options):
+    """ get the raw course section info from canvas api
+
+    canvas can't tell us which sections changed, so even an incremental
+    pull asks for the sections of every course, usually one page each:
+    an enrollment in a section that isn't stored is dropped
+    """
+
+    logger.info("Running import raw json sections for pull %s", pull.id)
+    course_ids = RawJson.objects.filter(
+        pull=pull, model="Course").order_by("id").values_list("api_id", flat=True)
+    progress = load_progress(pull, "sections")
+    course_ids = [c for c in course_ids if not (c in progress and progress[c].done)]
+    def iterate(course_id):
+        return canvasapi.iter_course_sections(
+            course_id,
+            start_url=progress[course_id].next_url if course_id in progress else None)
+    with RawJsonWriter(pull, options.get('batch_size') or default_batch_size,
+                       on_flush, commit_every_batch=True) as writer:
+        for course_id, (sections, next_url) in fetch_per_course(
+                course_ids, iterate, options.get('workers') or 1):
+            logger.debug("Got %s sections for Course %s", len(sections), course_id)
+            for section in sections:
+                writer.add("CourseSection", section)
+            writer.checkpoint(course_id, "sections", next_url)
+    logger.info("Saved %s raw json sections, skipped %s duplicates",
+                writer.inserted, writer.duplicates)
+    return writer.inserted
+
+def import_raw_json_enrollments(pull, on_flush=None, **options):
     """ here, users are students, teachers, etc.
 
     requires that Courses have been saved already
 
+    options['since'] is the previous pull's watermark; enrollments of
+    courses that were in the previous pull (options['known_course_ids'])
+    that didn't change since watermark_margin before it are left out of
+    the staging area (and so are never re-materialized).  a course seen
+    for the first time has all of its enrollments staged, however old.
+    canvas moves last_activity_at and total_activity_time without
+    touching updated_at, so an enrollment counts as changed at the later
+    of its updated_at and last_activity_at.  returns the latest of those
+    seen, to be the watermark of this pull.
+
     """
-    count = 0
-    for raw_json_course in RawJson.objects.filter(pull=pull, model="Course"):
-        print(raw_json_course.api_id)
-        if raw_json_course.api_id in lib.canvas.skip_course_ids:
-            print("skipping: course we don't want", raw_json_course.api_id)
+    since = options.get('since')
+    cutoff = since - watermark_margin if since else None
+    known_course_ids = options.get('known_course_ids') or set()
+    watermark = None
+    unchanged = 0
+    progress = load_progress(pull, "enrollments")
+    def iterate(course_id):
+        return canvasapi.iter_course_enrollments(
+            course_id, states=options.get('enrollment_states'),
+            start_url=progress[course_id].next_url if course_id in progress else None)
+    course_ids = []
+    for course_id in RawJson.objects.filter(
+            pull=pull, model="Course").order_by("id").values_list("api_id", flat=True):
+        if course_id in lib.canvas.skip_course_ids:
+            logger.info("skipping: course we don't want %s", course_id)
             continue
-        enrollments = canvasapi.get_course_enrollments(raw_json_course.api_id)
-        for json_obj in enrollments:
-            print("\n\n", json_obj, "\n\n")
-            record = RawJson(json=json.dumps(json_obj),
-                             model="Enrollment",
-                             api_id=json_obj["id"],
-                             pull=pull)
+        if course_id in progress and progress[course_id].done:
+            continue
+        course_ids.append(course_id)
+    with RawJsonWriter(pull, options.get('batch_size') or default_batch_size,
+                       on_flush, commit_every_batch=True) as writer:
+        for course_id, (enrollments, next_url) in fetch_per_course(
+                course_ids, iterate, options.get('workers') or 1):
+            for json_obj in enrollments:
+                row_logger.debug("enrollment %s", json_obj)
+                changed_at = max(filter(None, (
+                    lib.codec.parse_datetime(json_obj.get('updated_at')),
+                    lib.codec.parse_datetime(json_obj.get('last_activity_at')))),
+                                 default=None)
+                if changed_at and (watermark is None or changed_at > watermark):
+                    watermark = changed_at
+                if (cutoff and changed_at and changed_at < cutoff
+                        and course_id in known_course_ids):
+                    unchanged += 1
+                    continue
+                writer.add("Enrollment", json_obj)
+            writer.checkpoint(course_id, "enrollments", next_url)
+    logger.info("Saved %s raw json enrollments, skipped %s duplicates and "
+                "%s unchanged", writer.inserted, writer.duplicates, unchanged)
+    return watermark
+
+def unchanged_blobs(pull, model):
+    """ blobs of the previous finished pull, for objects that were already
+    materialized from exactly the same payload
+
+    the materializers drop objects (no course or section yet, no user,
+    a key stored under another id), so only blobs whose row exists
+    count; a dropped object is tried again the next time it's staged """
+    previous = Pull.objects.filter(id__lt=pull.id, finished_at__isnull=False,
+                                   ).order_by("-id").first()
+    if previous is None:
+        return None
+    return RawJson.objects.filter(
+        pull=previous, model=model, blob__isnull=False,
+        api_id__in=materialized_models[model].objects.values("id")).values(
+            "blob_id")
+
+def iter_raw_json_batches(pull, model, batch_size=default_batch_size,
+                          skip_unchanged=False, as_records=False):
+    """ yields lists of json objects of one model in a pull, decoded by
+    the JSONField, or with as_records the lib.canvas records made from
+    them (see record_classes)
+
+    rows are streamed from the database with .iterator() so only one
+    batch is ever held in memory.  with skip_unchanged, objects whose
+    content hash is the same as in the previous finished pull are left
+    out, since materializing them again wouldn't change anything
+    """
+    convert = record_classes[model].from_json if as_records else None
+    batch = []
+    rows = RawJson.objects.filter(pull=pull, model=model).order_by("id")
+    unchanged = unchanged_blobs(pull, model) if skip_unchanged else None
+    if unchanged is not None:
+        rows = rows.exclude(blob_id__in=unchanged)
+    for inline, blob in rows.values_list("json", "blob__json").iterator(
+            chunk_size=batch_size):
+        obj = blob if blob is not None else inline
+        batch.append(convert(obj) if convert else obj)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def upsert(model, records, batch_size=default_batch_size):
+    """ insert records, or update every non-key field of the ones whose
+    primary key already exists, in one statement per batch """
+    if not records:
+        return 0
+    update_fields = [f.name for f in model._meta.concrete_fields
+                     if not f.primary_key]
+    model.objects.bulk_create(records, batch_size=batch_size,
+                              update_conflicts=True,
+                              unique_fields=["id"],
+                              update_fields=update_fields)
+    return len(records)
+
+def materialize_courses(batch, **options):
+    """ upsert Course rows for a batch of lib.canvas.CourseRecords """
+    batch_size = options.get('batch_size') or default_batch_size
+    records = [Course(*record.astuple()) for record in batch
+               if record.id not in lib.canvas.skip_course_ids]
+    if options.get('pretend'):
+        return 0
+    return upsert(Course, records, batch_size)
+
+def materialize_course_sections(batch, course_ids, **options):
+    """ upsert CourseSection rows for a batch of lib.canvas.SectionRecords,
+    leaving out sections of courses not in course_ids """
+    batch_size = options.get('batch_size') or default_batch_size
+    records = [CourseSection(*record.astuple()) for record in batch
+               if record.course_id in course_ids
+               and record.course_id not in lib.canvas.skip_course_ids]
+    return upsert(CourseSection, records, batch_size)
+
+
+def stored_under_other_ids(ids_by_key):
+    """ the (user, course, type) keys of ids_by_key that are already
+    stored as an Enrollment with a different id, which would still trip
+    unique_together, so they have to be left alone """
+    existing = Enrollment.objects.filter(
+        course_id__in={k[1] for k in ids_by_key},
+        user_id__in={k[0] for k in ids_by_key}).values_list(
+            "id", "user_id", "course_id", "type")
+    keys = set()
+    for enrollment_id, *key in existing:
+        key = tuple(key)
+        if key in ids_by_key and ids_by_key[key] != enrollment_id:
+            row_logger.debug("skipping Enrollment %s, %s is already "
+                             "Enrollment %s", ids_by_key[key], key,
+                             enrollment_id)
+            keys.add(key)
+    return keys
+
+
+class EnrollmentMaterializer:
+    """ turns batches of lib.canvas.EnrollmentRecords into User and
+    Enrollment rows
+
+    requires that Courses and CourseSections have been saved already
+
+    a user shows up once per enrollment, so users are deduplicated in
+    memory and each distinct user is written once per pull.
+    enrollments are deduplicated on (user, course, type) the same way
+    the unique_together constraint would
+    """
+    def __init__(self, **options):
+        self.batch_size = options.get('batch_size') or default_batch_size
+        self.course_ids = set(Course.objects.values_list("id", flat=True))
+        self.section_ids = set(CourseSection.objects.values_list("id", flat=True))
+        self.seen_users = set()
+        self.seen_keys = set()
+        self.user_count = 0
+        self.enrollment_count = 0
+
+    def __call__(self, batch):
+        users = {}
+        enrollments = {}
+        for record in batch:
+            if record.course_id in lib.canvas.skip_course_ids:
+                row_logger.debug("skipping enrollment in course %s",
+                                 record.course_id)
+                continue
+            if (record.course_id not in self.course_ids or
+                record.course_section_id not in self.section_ids):
+                continue
+            if record.user is None:
+                # this seems to be when I'm not a teacher
+                row_logger.debug("not able to get user object from %s", record)
+                continue
+            key = record.key
+            if key in self.seen_keys:
+                continue
+            self.seen_keys.add(key)
+            if record.user.id not in self.seen_users:
+                self.seen_users.add(record.user.id)
+                users[record.user.id] = User(*record.user.astuple())
+            enrollments[key] = Enrollment(*record.astuple())
+        for key in stored_under_other_ids(
+                {key: e.id for key, e in enrollments.items()}):
+            del enrollments[key]
+        with transaction.atomic():
+            self.user_count += upsert(User, list(users.values()),
+                                      self.batch_size)
+            self.enrollment_count += upsert(Enrollment,
+                                            list(enrollments.values()),
+                                            self.batch_size)
+
+
+def in_sql(pull, model, **options):
+    """ whether a save_* stage should materialize inside the database
+    (sql_materialize) rather than decode each object in python, and the
+    unchanged blobs to leave out if so """
+    use_sql = ((options.get('materialize') or "sql") == "sql"
+               and sql_materialize.supported())
+    unchanged = (unchanged_blobs(pull, model)
+                 if use_sql and options.get('skip_unchanged') else None)
+    return use_sql, unchanged
+
+def course_chunks(rows, size):
+    """ lists of the json texts of whole courses, at least size long
+    (except the last), from (course id, text) rows ordered by course """
+    chunk = []
+    last = None
+    for course_id, text in rows:
+        if len(chunk) >= size and course_id != last:
+            yield chunk
+            chunk = []
+        chunk.append(text)
+        last = course_id
+    if chunk:
+        yield chunk
+
+
+def materialize_in_processes(pull, **options):
+    """ save the users and enrollments of a pull with a pool of
+    options['processes'] processes, returns (users written, enrollments
+    written)
+
+    the staged enrollments are read in course order and handed out a
+    few courses at a time to lib.materialize.prepare_enrollments on the
+    spawned processes, which do the decoding and
+    deduplicating.  sqlite allows one writer at a time, so there the
+    prepared rows are upserted here, one chunk per transaction; on
+    postgresql (outside a transaction) as many writer threads, each
+    with its own connection, upsert them in parallel.  at most
+    2*processes chunks are in flight either way
+    """
+    batch_size = options.get('batch_size') or default_batch_size
+    processes = options['processes']
+    unchanged = (unchanged_blobs(pull, "Enrollment")
+                 if options.get('skip_unchanged') else None)
+    parallel_writes = (connection.vendor == "postgresql"
+                       and not connection.in_atomic_block)
+    names = [name for name, _, _ in sql_materialize.enrollment_columns]
+    key_of = operator.itemgetter(*map(names.index, ("user_id", "course_id", "type")))
+    id_of = operator.itemgetter(names.index("id"))
+    lock = threading.Lock()
+    written_users = set()
+    counts = {"enrollments": 0}
+    # each writer thread keeps its connection for all of its chunks
+    writer_connections = {}
+
+    def write(prepared):
+        users, enrollments = prepared
+        with lock:
+            fresh = users.keys() - written_users
+            written_users.update(fresh)
+        # a parallel writer upserts every user of its chunk, in id order
+        # so concurrent transactions lock them in the same order, since
+        # the chunk that first had a user may not have committed yet
+        user_ids = sorted(users if parallel_writes else fresh)
+        dropped = stored_under_other_ids(
+            {key_of(e): id_of(e) for e in enrollments})
+        enrollments = [e for e in enrollments if key_of(e) not in dropped]
+        if parallel_writes:
+            with lock:
+                writer_connections[threading.get_ident()] = \
+                    connections[DEFAULT_DB_ALIAS]
+        with transaction.atomic():
+            sql_materialize.upsert_rows(
+                User, sql_materialize.user_columns,
+                [users[user_id] for user_id in user_ids])
+            count = sql_materialize.upsert_rows(
+                Enrollment, sql_materialize.enrollment_columns, enrollments)
+        with lock:
+            counts["enrollments"] += count
+
+    pool = ProcessPoolExecutor(
+        processes, mp_context=multiprocessing.get_context("spawn"),
+        initializer=lib.materialize.init_worker,
+        initargs=(list(Course.objects.values_list("id", flat=True)),
+                  list(CourseSection.objects.values_list("id", flat=True)),
+                  list(lib.canvas.skip_course_ids)))
+    writers = ThreadPoolExecutor(processes if parallel_writes else 1)
+    try:
+        with pool, writers:
+            prepared = deque()
+            writing = deque()
+
+            def hand_off(future):
+                if not parallel_writes:
+                    return write(future.result())
+                writing.append(writers.submit(write, future.result()))
+                if len(writing) >= 2 * processes:
+                    writing.popleft().result()
+
+            for chunk in course_chunks(
+                    sql_materialize.staged_texts(pull, "Enrollment", unchanged),
+                    batch_size):
+                prepared.append(pool.submit(
+                    lib.materialize.prepare_enrollments, chunk))
+                if len(prepared) >= 2 * processes:
+                    hand_off(prepared.popleft())
+            while prepared:
+                hand_off(prepared.popleft())
+            while writing:
+                writing.popleft().result()
+    finally:
+        # the writer threads are done by now, so their connections can
+        # be closed from here
+        for writer_connection in writer_connections.values():
+            writer_connection.inc_thread_sharing()
+            writer_connection.close()
+    return len(written_users), counts["enrollments"]
 
-            try:
-                record.save()
-                count += 1
-            except IntegrityError as e:
-                print(e)
-            except Exception as e:
-                raise e
-    print(f"Saved {count} raw json enrollments")
 
 def save_courses(pull, **options):
-    count = 0
-    for raw_json_course in RawJson.objects.filter(pull=pull, model="Course"):
-        print(raw_json_course.json)
-        json_obj = json.loads(raw_json_course.json)
-        if not options.get('pretend'):
-            record = Course(id=json_obj.get('id'),
-                            name=json_obj.get('name'),
-                            account_id=json_obj.get('account_id'),
-                            uuid=json_obj.get('uuid'),
-                            start_at=json_obj.get('start_at'),
-                            created_at=json_obj.get('created_at'),
-                            course_code=json_obj.get('course_code'),
-                            enrollment_term_id=json_obj.get('enrollment_term_id'),
-                            end_at=json_obj.get('end_at'),
-                            sis_course_id=json_obj.get('sis_course_id'),
-            )
-            try:
-                if record.id not in lib.canvas.skip_course_ids:
-                    record.save()
-            except Exception as e:
-                raise e
+    batch_size = options.get('batch_size') or default_batch_size
+    use_sql, unchanged = in_sql(pull, "Course", **options)
+    if use_sql:
+        count = (0 if options.get('pretend') else
+                 sql_materialize.materialize_courses(pull, unchanged))
+    else:
+        count = 0
+        for batch in iter_raw_json_batches(pull, "Course", batch_size,
+                                           options.get('skip_unchanged', False),
+                                           as_records=True):
+            count += materialize_courses(batch, **options)
+    logger.info("Saved %s courses", count)
+    return count
 
 def save_course_sections(pull, **options):
-    for raw_json_section in RawJson.objects.filter(pull=pull,
-                                                  model="CourseSection"):
-        json_obj = json.loads(raw_json_section.json)
-        record = CourseSection(id = json_obj.get('id'),
-                               course_id = json_obj.get('course_id'),
-                               name = json_obj.get('name'),
-                               start_at = json_obj.get('start_at'),
-                               end_at = json_obj.get('end_at'),
-                               created_at = json_obj.get('created_at'),
-                               sis_section_id = json_obj.get('sys_section_id'),
-                               sis_course_id = json_obj.get('sys_course_id') )
-        try:
-            if record.course_id not in lib.canvas.skip_course_ids:
-                record.save()
-        except IntegrityError as e:
-            print(e)
+    batch_size = options.get('batch_size') or default_batch_size
+    use_sql, unchanged = in_sql(pull, "CourseSection", **options)
+    if use_sql:
+        count = sql_materialize.materialize_course_sections(pull, unchanged)
+    else:
+        course_ids = set(Course.objects.values_list("id", flat=True))
+        count = 0
+        for batch in iter_raw_json_batches(pull, "CourseSection", batch_size,
+                                           options.get('skip_unchanged', False),
+                                           as_records=True):
+            count += materialize_course_sections(batch, course_ids, **options)
+    logger.info("Saved %s course sections", count)
+    return count
 
 
 def save_users_and_enrollments(pull, **options):
@@ -151,67 +669,284 @@ def save_users_and_enrollments(pull, **options):
     requires that Courses have been saved already
 
     """
-    for raw_json_course in RawJson.objects.filter(pull=pull, model="Enrollment"):
-        if raw_json_course.api_id in lib.canvas.skip_course_ids:
-            print("skipping", raw_json_course.api_id)
-            continue
-        json_obj = json.loads(raw_json_course.json)
-        try:
-            userobj = json_obj['user']
-        except TypeError: # this seems to be when I'm not a teacher
-            print("not able to get user object from ", json_obj)
-
-        userrecord = User(id=userobj.get('id'),
-                          name=userobj.get('name'),
-                          created_at=userobj.get('created_at'),
-                          sortable_name=userobj.get('sortable_name'),
-                          short_name=userobj.get('short_name'),
-                          sis_user_id=userobj.get('sis_user_id'),
-                          root_account=userobj.get('root_account'),
-                          login_id=userobj.get('login_id')
-                          )
-        try:
-            if json_obj['course_id'] not in lib.canvas.skip_course_ids:
-                userrecord.save()
-        except IntegrityError as e:
-            print(e)
-        except Exception as e:
-            raise e
-        enrollrecord = Enrollment(
-            id=json_obj.get('id'),
-            user_id=json_obj.get('user_id'),
-            course_id=json_obj.get('course_id'),
-            type=json_obj.get('type'),
-            created_at=json_obj.get('created_at'),
-            updated_at=json_obj.get('updated_at'),
-            course_section_id=json_obj.get('course_section_id'),
-            enrollment_state=json_obj.get('enrollment_state'),
-            role=json_obj.get('role'),
-            role_id=json_obj.get('role_id'),
-            last_activity_at=json_obj.get('last_activity_at'),
-            last_attended_at=json_obj.get('last_attended_at'),
-            total_activity_time=json_obj.get('total_activity_time')
-        )
-        try:
-            if json_obj['course_id'] not in lib.canvas.skip_course_ids:
-                enrollrecord.save()
-        except IntegrityError as e:
-            print(e)
+    batch_size = options.get('batch_size') or default_batch_size
+    processes = options.get('processes') or 1
+    use_sql, unchanged = in_sql(pull, "Enrollment", **options)
+    if use_sql:
+        with transaction.atomic():
+            users, enrollments = \
+                sql_materialize.materialize_users_and_enrollments(pull, unchanged)
+    elif processes > 1 and sql_materialize.supported():
+        users, enrollments = materialize_in_processes(pull, **options)
+    else:
+        materialize = EnrollmentMaterializer(**options)
+        for batch in iter_raw_json_batches(pull, "Enrollment", batch_size,
+                                           options.get('skip_unchanged', False),
+                                           as_records=True):
+            materialize(batch)
+        users, enrollments = materialize.user_count, materialize.enrollment_count
+    logger.info("Saved %s users and %s enrollments", users, enrollments)
+    return users + enrollments
+
+
+def save_course_summaries(pull, **options):
+    """ rebuild the CourseSummary of every course whose enrollments the
+    pull changed, and of courses that have none yet """
+    unchanged = (unchanged_blobs(pull, "Enrollment")
+                 if options.get('skip_unchanged', False) else None)
+    count = refresh_course_summaries(changed_course_ids(pull, unchanged))
+    logger.info("Saved %s course summaries", count)
+    return count
+
+
+def materialize_on_flush(pull, model, materialize, skip_unchanged=False):
+    """ an on_flush callback for RawJsonWriter that materializes each batch
+    as soon as it's staged, skipping objects unchanged since the previous
+    pull like iter_raw_json_batches does.  materialize gets the batch as
+    lib.canvas records """
+    convert = record_classes[model].from_json
+    unchanged = unchanged_blobs(pull, model) if skip_unchanged else None
+    def on_flush(pairs):
+        if unchanged is not None:
+            same = set(unchanged.filter(
+                blob_id__in=[h for h, _ in pairs]).values_list("blob_id",
+                                                               flat=True))
+            pairs = [(h, obj) for h, obj in pairs if h not in same]
+        materialize([convert(obj) for _, obj in pairs])
+    return on_flush
+
+def stream_pull(pull, **options):
+    """ stage and materialize a pull one batch at a time
+
+    each batch of RawJson rows is materialized right after it's
+    inserted, from the objects still in memory, instead of reading the
+    whole pull back from RawJson afterwards.  together with the page
+    generators in lib.canvas, no stage ever holds more than a batch
+    (plus a few pages per worker) in memory.  returns the watermark
+    like import_raw_json_enrollments
+    """
+    skip_unchanged = options.get('skip_unchanged', False)
+    import_raw_json_courses(pull, on_flush=materialize_on_flush(
+        pull, "Course", partial(materialize_courses, **options),
+        skip_unchanged), **options)
+    course_ids = set(Course.objects.values_list("id", flat=True))
+    import_raw_json_sections(pull, on_flush=materialize_on_flush(
+        pull, "CourseSection",
+        partial(materialize_course_sections, course_ids=course_ids, **options),
+        skip_unchanged), **options)
+    materialize = EnrollmentMaterializer(**options)
+    watermark = import_raw_json_enrollments(pull, on_flush=materialize_on_flush(
+        pull, "Enrollment", materialize, skip_unchanged), **options)
+    logger.info("Saved %s users and %s enrollments", materialize.user_count,
+                materialize.enrollment_count)
+    return watermark
 
 
 class Command(BaseCommand):
 
     help = "reads courses from the canvas api"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=1,
+            help="number of courses to fetch sections/enrollments for "
+            "concurrently (default 1, i.e. one after another)")
+        parser.add_argument(
+            "--prefetch", type=int, default=lib.canvas.default_prefetch,
+            help="number of pages of one endpoint to fetch concurrently when "
+            f"canvas numbers its pages (default {lib.canvas.default_prefetch})")
+        parser.add_argument(
+            "--per-page", action="append", metavar="ENDPOINT=N",
+            help="largest page size to ask for on an endpoint (courses, "
+            f"sections or enrollments, default {lib.canvas.max_per_page}); "
+            "smaller sizes are picked automatically when pages get slow or "
+            "expensive")
+        parser.add_argument(
+            "--cache", metavar="PATH",
+            help="sqlite file to cache pages in, so repeat pulls can ask "
+            "canvas for only what changed (ETag / Last-Modified)")
+        parser.add_argument(
+            "--cache-size", type=int, metavar="MB",
+            default=lib.response_cache.default_max_bytes // (1024 * 1024),
+            help="evict least recently used pages past this size")
+        parser.add_argument(
+            "--batch-size", type=int, default=default_batch_size,
+            help="number of RawJson rows per bulk insert "
+            f"(default {default_batch_size})")
+        parser.add_argument(
+            "--incremental", action="store_true",
+            help="only stage and materialize what changed since the last "
+            "finished pull (falls back to a full pull if there is none). "
+            "enrollments count as changed when their updated_at or "
+            "last_activity_at moved; total_activity_time alone is only "
+            "picked up by a full pull")
+        parser.add_argument(
+            "--enrollment-state", action="append", dest="enrollment_states",
+            metavar="STATE",
+            help="only ask canvas for enrollments in this state, e.g. active "
+            "or invited; may be given more than once")
+        parser.add_argument(
+            "--rematerialize", action="store_false", dest="skip_unchanged",
+            help="materialize every staged object, even those identical "
+            "to the previous pull")
+        parser.add_argument(
+            "--stream", action="store_true",
+            help="materialize each batch as soon as it's staged instead of "
+            "after the whole pull is staged, keeping memory flat")
+        parser.add_argument(
+            "--materialize", choices=["sql", "python"], default="sql",
+            help="turn staged json into rows with INSERT ... SELECT inside "
+            "the database (sql, the default on sqlite and postgresql) or by "
+            "decoding it in python; --stream always uses python")
+        parser.add_argument(
+            "--processes", type=int, default=1, metavar="N",
+            help="with --materialize python, decode the staged enrollments "
+            "on N processes, a few courses at a time (default 1)")
+        parser.add_argument(
+            "--resume", type=int, metavar="PULL_ID",
+            help="pick up an unfinished pull where it stopped instead of "
+            "starting a new one")
+        parser.add_argument(
+            "--record", metavar="PATH",
+            help="also write every canvas response to this gzipped json "
+            "lines archive, for --replay; not with --cache")
+        parser.add_argument(
+            "--replay", metavar="PATH",
+            help="serve pages from an archive made with --record instead of "
+            "canvas; no token needed")
+        parser.add_argument(
+            "--replay-latency-ms", type=int, default=0, metavar="MS",
+            help="time each replayed request takes (default 0)")
+        parser.add_argument(
+            "--replay-bucket-size", type=int, metavar="UNITS",
+            help="simulate canvas's rate limit bucket of this size while "
+            "replaying (canvas uses 700), default no throttling")
+        parser.add_argument(
+            "--log-sample", type=int, default=default_log_sample, metavar="N",
+            help="at -v 2, log only one in N per object messages "
+            f"(default {default_log_sample}); -v 3 logs all of them")
+
     def handle(self, *args, **options):
-        pull = Pull()
+        verbosity = options['verbosity']
+        lib.logs.set_level(lib.logs.verbosity_level(verbosity),
+                           "lib", "canvas")
+        sample = lib.logs.SampleFilter(1 if verbosity > 2 else options['log_sample'])
+        row_logger.addFilter(sample)
+        try:
+            with lib.logs.queued("lib", "canvas"):
+                self.sync(**options)
+        finally:
+            row_logger.removeFilter(sample)
+
+    def sync(self, **options):
+        global canvasapi
+        if options['record'] and options['replay']:
+            raise CommandError("--record and --replay don't go together")
+        if options['record'] and options['cache']:
+            # the archive would get canvas's empty 304s, not the cached pages
+            raise CommandError("--record and --cache don't go together")
+        # a client from an earlier run in this process is reused only if
+        # it talks to canvas itself: one that recorded has closed its
+        # archive and one that replayed would keep replaying
+        if (canvasapi is None or options['record'] or options['replay']
+                or canvasapi.recorder is not None
+                or canvasapi.transport is not None):
+            canvasapi = connect(**options)
+        canvasapi.prefetch = options['prefetch']
+        # and it gets this run's --cache, or none, not the last run's
+        if canvasapi.cache is not None:
+            canvasapi.cache.close()
+            canvasapi.cache = None
+        if options['cache']:
+            canvasapi.cache = lib.response_cache.ResponseCache(
+                options['cache'], options['cache_size'] * 1024 * 1024)
+        for setting in options['per_page'] or []:
+            endpoint, _, size = setting.partition("=")
+            if endpoint not in lib.canvas.endpoint_per_page or not size.isdigit():
+                raise CommandError(f"--per-page wants ENDPOINT=N with ENDPOINT "
+                                   f"one of {', '.join(lib.canvas.endpoint_per_page)}")
+            canvasapi.sizer.configured[endpoint] = min(int(size),
+                                                      lib.canvas.max_per_page)
+        connections = options['workers'] * max(1, options['prefetch'])
+        if connections > lib.canvas.default_pool_size:
+            canvasapi.set_pool_size(connections)
+        if options['resume']:
+            try:
+                pull = Pull.objects.get(id=options['resume'])
+            except Pull.DoesNotExist:
+                raise CommandError(f"there is no Pull {options['resume']}")
+            if pull.finished_at:
+                raise CommandError(f"Pull {pull.id} already finished "
+                                   f"at {pull.finished_at}")
+            previous = Pull.objects.filter(
+                id__lt=pull.id, finished_at__isnull=False).order_by(
+                    "-id").first() if pull.incremental else None
+            logger.info("Resuming Pull %s", pull.id)
+        else:
+            previous = Pull.latest_finished() if options['incremental'] else None
+            if options['incremental'] and previous is None:
+                logger.info("No finished pull to continue from, doing a full pull")
+            pull = Pull(incremental=previous is not None)
+            pull.save()
+        options['since'] = previous.watermark if previous else None
+        options['known_course_ids'] = set(RawJson.objects.filter(
+            pull=previous, model="Course").values_list(
+                "api_id", flat=True)) if previous else set()
+        logger.info("Running Pull %s%s", pull.id,
+                    f" (changes since {options['since']})" if previous else "")
+        metrics = PullMetrics(canvasapi.throttle)
+        try:
+            if options['stream']:
+                with metrics.stage("stream") as stage:
+                    watermark = stream_pull(pull, **options)
+                stage["rows"] = RawJson.objects.filter(pull=pull).count()
+            else:
+                with metrics.stage("stage courses") as stage:
+                    stage["rows"] = import_raw_json_courses(pull, **options)
+                with metrics.stage("stage sections") as stage:
+                    stage["rows"] = import_raw_json_sections(pull, **options)
+                with metrics.stage("stage enrollments") as stage:
+                    watermark = import_raw_json_enrollments(pull, **options)
+                stage["rows"] = RawJson.objects.filter(
+                    pull=pull, model="Enrollment").count()
+
+                with metrics.stage("save courses") as stage:
+                    stage["rows"] = save_courses(pull, **options)
+                with metrics.stage("save sections") as stage:
+                    stage["rows"] = save_course_sections(pull, **options)
+                with metrics.stage("save users and enrollments") as stage:
+                    stage["rows"] = save_users_and_enrollments(pull, **options)
+            with metrics.stage("save course summaries") as stage:
+                stage["rows"] = save_course_summaries(pull, **options)
+        except BaseException:
+            logger.error("Pull %s did not finish, pick it up again with "
+                         "--resume %s", pull.id, pull.id)
+            pull.report = metrics.report()
+            pull.save(update_fields=["report"])
+            raise
+        finally:
+            logger.info("Pull %s stages:\n%s", pull.id, metrics.table())
+            if canvasapi.recorder is not None:
+                canvasapi.recorder.close()
+                logger.info("Recorded %s responses to %s",
+                            canvasapi.recorder.count, canvasapi.recorder.path)
+
+        logger.info("Throttle state after pull %s: %s", pull.id,
+                    canvasapi.throttle.state())
+        if canvasapi.transport is not None:
+            logger.info("Replay after pull %s: %s", pull.id,
+                        canvasapi.transport.state())
+        if canvasapi.cache is not None:
+            logger.info("Response cache after pull %s: %s", pull.id,
+                        canvasapi.cache.state())
+        for endpoint, stats in canvasapi.sizer.summary().items():
+            logger.info("Pull %s %s: %s requests for %s results, per_page %s, "
+                        "avg %s ms, avg cost %s", pull.id, endpoint,
+                        stats['requests'], stats['results'],
+                        stats['sizes_used'], stats['avg_ms'], stats['avg_cost'])
+
+        pull.watermark = max(filter(None, [watermark, options['since']]),
+                             default=None)
+        pull.finished_at = timezone.now()
+        pull.report = metrics.report()
         pull.save()
-        #pull = Pull.objects.get(id=26)
-        print(f"Running Pull {pull.id}")
-        import_raw_json_courses(pull, **options)
-        import_raw_json_sections(pull, **options)
-        import_raw_json_enrollments(pull, **options)
-
-        save_courses(pull, **options)
-        save_course_sections(pull)
-        save_users_and_enrollments(pull, **options)
@@ -0,0 +1,140 @@
+"""where the time of a pull goes, stage by stage
+
+    metrics = PullMetrics(canvasapi.throttle)
+    with metrics.stage("save courses") as stage:
+        stage["rows"] = save_courses(pull)
+    print(metrics.table())
+    pull.report = metrics.report()
+
+every stage records its wall time, the http requests it made (and
+bytes and throttle waits, from the lib.canvas.Throttle all requests go
+through) and the sql queries it ran, counted and timed with an
+execute_wrapper on every connection of the process, so the queries of
+the --processes writer threads count too.  rows is whatever the stage
+says it wrote.
+"""
+import contextlib
+import threading
+import time
+
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+columns = ("seconds", "http_requests", "http_bytes", "throttled",
+           "throttle_wait_ms", "queries", "query_ms", "rows")
+# Throttle.state() key behind each http column
+throttle_keys = {"http_requests": "requests", "http_bytes": "bytes",
+                 "throttled": "throttled", "throttle_wait_ms": "waited_ms"}
+
+
+class QueryCounter:
+    """ the number of statements run while it's counting, on any thread,
+    and their time
+
+        with QueryCounter() as queries:
+            ...
+        print(queries.count, queries.seconds)
+    """
+    lock = threading.Lock()
+    # the counters counting right now
+    counting = set()
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+
+    def __enter__(self):
+        watch(connection=connection)
+        with self.lock:
+            self.counting.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.lock:
+            self.counting.discard(self)
+        return False
+
+    @classmethod
+    def execute(cls, execute, sql, params, many, context):
+        """ the execute_wrapper on every connection """
+        if not cls.counting:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            with cls.lock:
+                for counter in cls.counting:
+                    counter.count += 1
+                    counter.seconds += elapsed
+
+
+def watch(sender=None, connection=None, **kwargs):
+    """ put QueryCounter.execute on a connection, first so that it stays
+    when the wrappers of connection.execute_wrapper blocks are popped.
+    connected to connection_created, for the connections other threads
+    open """
+    if QueryCounter.execute not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, QueryCounter.execute)
+
+
+connection_created.connect(watch)
+
+
+class PullMetrics:
+    """ collects the metrics of each stage of a pull """
+    def __init__(self, throttle=None):
+        self.throttle = throttle
+        self.stages = []
+
+    def throttle_state(self):
+        state = self.throttle.state() if self.throttle is not None else {}
+        return {column: state.get(key) or 0
+                for column, key in throttle_keys.items()}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ measure the block as one stage; yields its record so the block
+        can fill in rows.  the record is kept even if the stage fails """
+        record = {"stage": name, "rows": 0}
+        self.stages.append(record)
+        before = self.throttle_state()
+        queries = QueryCounter()
+        start = time.perf_counter()
+        try:
+            with queries:
+                yield record
+        except BaseException:
+            record["failed"] = True
+            raise
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 3)
+            after = self.throttle_state()
+            for column in throttle_keys:
+                record[column] = round(after[column] - before[column], 1)
+            record["queries"] = queries.count
+            record["query_ms"] = round(queries.seconds * 1000, 1)
+
+    def totals(self):
+        return {column: round(sum(s.get(column, 0) for s in self.stages), 3)
+                for column in columns}
+
+    def report(self):
+        """ json for Pull.report """
+        return {"stages": self.stages, "total": self.totals()}
+
+    def table(self):
+        """ the report as a fixed width text table """
+        rows = [[s["stage"] + (" (failed)" if s.get("failed") else "")]
+                + [s.get(c, "") for c in columns] for s in self.stages]
+        rows.append(["total"] + list(self.totals().values()))
+        header = ["stage"] + list(columns)
+        widths = [max(len(str(row[i])) for row in rows + [header])
+                  for i in range(len(header))]
+        lines = []
+        for row in [header] + rows:
+            lines.append("  ".join(
+                str(value).ljust(width) if i == 0 else str(value).rjust(width)
+                for i, (value, width) in enumerate(zip(row, widths))))
+        return "\n".join(lines)
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas', '0007_alter_qualitativereview_course_section'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pull',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='pull',
+            name='incremental',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='pull',
+            name='watermark',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas', '0008_pull_finished_at_pull_incremental_pull_watermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RawJsonBlob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('json', models.TextField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='rawjson',
+            name='json',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='rawjson',
+            name='blob',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.PROTECT, to='canvas.rawjsonblob'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas', '0009_rawjsonblob_alter_rawjson_json_rawjson_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PullProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('course_id', models.BigIntegerField()),
+                ('endpoint', models.CharField(max_length=100)),
+                ('next_url', models.TextField(blank=True, default=None, null=True)),
+                ('done', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('pull', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='canvas.pull')),
+            ],
+            options={
+                'unique_together': {('pull', 'course_id', 'endpoint')},
+            },
+        ),
+    ]
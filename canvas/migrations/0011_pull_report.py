@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas', '0010_pullprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pull',
+            name='report',
+            field=models.JSONField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas', '0011_pull_report'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='course',
+            index=models.Index(fields=['-start_at', 'name', 'id'], name='course_start_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rawjson',
+            index=models.Index(fields=['pull', 'model', 'id'], name='rawjson_pull_model_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations, models
+
+
+def empty_to_null(apps, schema_editor):
+    RawJson = apps.get_model("canvas", "RawJson")
+    RawJson.objects.filter(json="").update(json=None)
+
+
+def null_to_empty(apps, schema_editor):
+    RawJson = apps.get_model("canvas", "RawJson")
+    RawJson.objects.filter(json__isnull=True).update(json="")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas', '0012_hot_path_indexes'),
+    ]
+
+    operations = [
+        # "" isn't valid json, so rows whose payload lives in a blob get
+        # null before the column becomes a JSONField
+        migrations.AlterField(
+            model_name='rawjson',
+            name='json',
+            field=models.TextField(blank=True, default=None, null=True),
+        ),
+        migrations.RunPython(empty_to_null, null_to_empty),
+        migrations.AlterField(
+            model_name='rawjson',
+            name='json',
+            field=models.JSONField(blank=True, default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name='rawjsonblob',
+            name='json',
+            field=models.JSONField(),
+        ),
+    ]
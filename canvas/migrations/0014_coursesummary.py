@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('canvas', '0013_rawjson_jsonfield'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourseSummary',
+            fields=[
+                ('course', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='canvas.course')),
+                ('enrollments', models.IntegerField(default=0)),
+                ('students', models.IntegerField(default=0)),
+                ('teachers', models.IntegerField(default=0)),
+                ('counts', models.JSONField(default=dict)),
+                ('last_activity_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('total_activity_time', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
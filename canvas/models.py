@@ -1,7 +1,8 @@
+import hashlib
 from datetime import date
 from django.db import models
 from django.utils.timezone import now
-#from django.contrib.postgres.fields import JSONField
+import lib.codec
 
 INPERSON = "inperson"
 VIRTUAL = "virtual"
@@ -27,8 +28,66 @@ class Pull(models.Model):
     responsesused to set up the db, first to RawJson as a staging
     area, then to the actual db.
 
+    an incremental pull only stages what changed since the previous
+    finished pull's watermark, the latest enrollment updated_at or
+    last_activity_at seen.
+
+    report is the per stage timing, http and query counts of the pull
+    (canvas.metrics.PullMetrics.report), written even if it failed.
+
     """
     ts = models.DateTimeField(auto_now_add=True)
+    incremental = models.BooleanField(default=False)
+    finished_at = models.DateTimeField(blank=True, default=None, null=True)
+    watermark = models.DateTimeField(blank=True, default=None, null=True)
+    report = models.JSONField(blank=True, default=None, null=True)
+
+    @classmethod
+    def latest_finished(cls):
+        return cls.objects.filter(finished_at__isnull=False).order_by(
+            "-finished_at").first()
+
+class PullProgress(models.Model):
+    """how far a pull got with one paginated endpoint
+
+    next_url is the canvas pagination cursor of the first page that
+    hasn't been staged yet; done is set once the last page is in.
+    the courses list itself is tracked with course_id 0.  these are
+    written in the same transaction as the RawJson rows they cover, so
+    a crashed pull can be picked up again with
+    sync_canvas_data --resume PULL_ID
+
+    """
+    pull = models.ForeignKey(Pull, on_delete=models.CASCADE)
+    course_id = models.BigIntegerField()
+    endpoint = models.CharField(max_length=100)
+    next_url = models.TextField(blank=True, default=None, null=True)
+    done = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+    class Meta:
+        unique_together = [['pull', 'course_id', 'endpoint']]
+
+def canonical_json(obj):
+    """ the serialization that content hashes are computed over, the
+    same whichever lib.codec is in use """
+    return lib.codec.canonical(obj)
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class RawJsonBlob(models.Model):
+    """one distinct json payload from the canvas api
+
+    RawJson rows from any number of pulls point at the same blob when
+    the object didn't change between them, so the staging area grows
+    with the amount of change rather than with the number of pulls.
+    the primary key is the sha256 of the canonical_json() text; json is
+    a JSONField (jsonb on postgresql, JSON1 text on sqlite) so the
+    materializers can pull fields out of it in sql
+
+    """
+    hash = models.CharField(max_length=64, primary_key=True)
+    json = models.JSONField()
 
 class RawJson(models.Model):
 
@@ -39,8 +98,14 @@ class RawJson(models.Model):
     for indexing purposes, we'll use the id from Canvas as the primary
     key
 
+    the payload lives in blob; json is only filled in for rows staged
+    before blobs existed (see the compact_raw_json command) and is null
+    otherwise
+
     """
-    json = models.TextField()
+    json = models.JSONField(blank=True, default=None, null=True)
+    blob = models.ForeignKey(RawJsonBlob, blank=True, default=None, null=True,
+                             on_delete=models.PROTECT)
     api_id = models.BigIntegerField()
     model = models.CharField(max_length=100, blank=True, default=None,
                              null=True)
@@ -48,9 +113,18 @@ class RawJson(models.Model):
     selected = models.BooleanField(default=False)
     class Meta:
         unique_together = [['api_id', 'pull', 'model']]
+        indexes = [
+            # every stage reads one model of one pull in id order
+            models.Index(fields=["pull", "model", "id"],
+                         name="rawjson_pull_model_idx"),
+        ]
     def __str__(self):
         return f"Course(id={self.id})"
 
+    @property
+    def payload(self):
+        return self.blob.json if self.blob_id else self.json
+
 class Course(models.Model):
     """ a model for a course
 
@@ -70,6 +144,13 @@ class Course(models.Model):
     end_at = models.DateTimeField(blank=True, default=None, null=True)
     sis_course_id = models.CharField(max_length=100, blank=True, default=None, null=True)
 
+    class Meta:
+        indexes = [
+            # the course lists and courses-json are newest first
+            models.Index(fields=["-start_at", "name", "id"],
+                         name="course_start_at_idx"),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -152,6 +233,27 @@ class Enrollment(models.Model):
     class Meta:
         unique_together = ('user', 'course', 'type')
 
+class CourseSummary(models.Model):
+    """ the enrollment stats of a course, precomputed
+
+    sync_canvas_data rebuilds the summaries of the courses each pull
+    touched (see canvas.summaries), so the course lists and
+    courses-json read one row per course instead of aggregating its
+    enrollments on every request.  students and teachers count active
+    enrollments; counts has every {type: {state: number}}
+
+    """
+    course = models.OneToOneField(Course, primary_key=True,
+                                  on_delete=models.CASCADE,
+                                  related_name="summary")
+    enrollments = models.IntegerField(default=0)
+    students = models.IntegerField(default=0)
+    teachers = models.IntegerField(default=0)
+    counts = models.JSONField(default=dict)
+    last_activity_at = models.DateTimeField(blank=True, default=None, null=True)
+    total_activity_time = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
 class ClassSesh(models.Model):
     """ a course meets for (usually) 14 class sessions per semester
     """
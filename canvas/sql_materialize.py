@@ -0,0 +1,202 @@
+"""materialize staged RawJson inside the database
+
+each function here turns the RawJson rows of one model of a pull into
+Course, CourseSection, User or Enrollment rows with a single
+INSERT ... SELECT ... ON CONFLICT (id) DO UPDATE statement, pulling the
+fields out of the json with the database's own json functions
+(json_extract on sqlite, #>> on postgresql) instead of decoding every
+object in python.  they make the same choices as the python
+materializers in sync_canvas_data: courses in lib.canvas.skip_course_ids
+are left out, sections and enrollments need their course (and
+section) to exist, enrollments are deduplicated on (user, course,
+type) keeping the first one staged, and an enrollment whose key is
+already stored under another id is skipped.  the columns and their
+types come from the lib.canvas records the python materializers use.
+
+only sqlite and postgresql are supported(); anything else goes through
+the python materializers.
+"""
+import datetime
+
+from django.db import connection
+
+import lib.canvas
+from canvas.models import (RawJson, RawJsonBlob, Course, CourseSection, User,
+                           Enrollment)
+
+
+def columns(record_class, prefix=()):
+    """ (column, kind, json path) of each field of a lib.canvas record
+    that is a model column """
+    kinds = {int: "int", datetime.datetime: "datetime"}
+    return [(name, kinds.get(type_, "text"), prefix + (name,))
+            for name, type_ in record_class.columns()]
+
+
+course_columns = columns(lib.canvas.CourseRecord)
+section_columns = columns(lib.canvas.SectionRecord)
+user_columns = columns(lib.canvas.UserRecord, ("user",))
+enrollment_columns = columns(lib.canvas.EnrollmentRecord)
+
+
+def supported():
+    return connection.vendor in ("sqlite", "postgresql")
+
+
+def field(doc, kind, path):
+    """ sql pulling one field out of the json document doc """
+    if connection.vendor == "postgresql":
+        text = f"({doc} #>> '{{{','.join(path)}}}')"
+        return {"int": f"{text}::bigint",
+                "datetime": f"{text}::timestamptz"}.get(kind, text)
+    value = f"json_extract({doc}, '$.{'.'.join(path)}')"
+    # datetime() turns canvas's 2022-01-10T00:00:00Z into the utc
+    # 2022-01-10 00:00:00 django stores
+    return f"datetime({value})" if kind == "datetime" else value
+
+
+def is_object(doc, key):
+    if connection.vendor == "postgresql":
+        return f"jsonb_typeof({doc} -> '{key}') = 'object'"
+    return f"json_type({doc}, '$.{key}') = 'object'"
+
+
+def table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def staged(pull, model, unchanged=None):
+    """ (from and where sql, params) for the staged json of one model of
+    a pull as `doc`, minus the blobs in the unchanged queryset """
+    sql = (f"{table(RawJson)} r LEFT JOIN {table(RawJsonBlob)} b "
+           f"ON b.hash = r.blob_id WHERE r.pull_id = %s AND r.model = %s")
+    params = [pull.id, model]
+    if unchanged is not None:
+        unchanged_sql, unchanged_params = unchanged.query.sql_with_params()
+        sql += f" AND (r.blob_id IS NULL OR r.blob_id NOT IN ({unchanged_sql}))"
+        params += list(unchanged_params)
+    return sql, params
+
+
+doc = "COALESCE(b.json, r.json)"
+
+
+def not_skipped(course_id_sql):
+    """ (sql, params) leaving out lib.canvas.skip_course_ids """
+    if not lib.canvas.skip_course_ids:
+        return "1 = 1", []
+    marks = ", ".join(["%s"] * len(lib.canvas.skip_course_ids))
+    return (f"{course_id_sql} NOT IN ({marks})",
+            sorted(lib.canvas.skip_course_ids))
+
+
+def upsert_sql(model, columns, select_sql):
+    """ the select goes after INSERT INTO, with any WITH of its own: a
+    statement starting with WITH gets no rowcount from python's sqlite3 """
+    quote = connection.ops.quote_name
+    names = ", ".join(quote(c) for c, _, _ in columns)
+    updates = ", ".join(f"{quote(c)} = excluded.{quote(c)}"
+                        for c, _, _ in columns if c != "id")
+    return (f"INSERT INTO {table(model)} ({names}) {select_sql} "
+            f"ON CONFLICT (id) DO UPDATE SET {updates}")
+
+
+def execute(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return max(cursor.rowcount, 0)
+
+
+def select(columns, source=doc):
+    return ", ".join(field(source, kind, path) for _, kind, path in columns)
+
+
+def materialize_courses(pull, unchanged=None):
+    """ upsert the courses of a pull, returns the number of rows written """
+    source, params = staged(pull, "Course", unchanged)
+    skip, skip_params = not_skipped(field(doc, "int", ("id",)))
+    sql = upsert_sql(Course, course_columns,
+                     f"SELECT {select(course_columns)} FROM {source} AND {skip}")
+    return execute(sql, params + skip_params)
+
+
+def materialize_course_sections(pull, unchanged=None):
+    """ upsert the sections (of courses we have) of a pull """
+    source, params = staged(pull, "CourseSection", unchanged)
+    course_id = field(doc, "int", ("course_id",))
+    skip, skip_params = not_skipped(course_id)
+    sql = upsert_sql(CourseSection, section_columns,
+                     f"SELECT {select(section_columns)} FROM {source} "
+                     f"AND {course_id} IN (SELECT id FROM {table(Course)}) "
+                     f"AND {skip}")
+    return execute(sql, params + skip_params)
+
+
+def materialize_users_and_enrollments(pull, unchanged=None):
+    """ upsert the users and enrollments of a pull, returns
+    (users written, enrollments written) """
+    source, params = staged(pull, "Enrollment", unchanged)
+    course_id = field(doc, "int", ("course_id",))
+    section_id = field(doc, "int", ("course_section_id",))
+    skip, skip_params = not_skipped(course_id)
+    key = ", ".join([field(doc, "int", ("user_id",)), course_id,
+                     field(doc, "text", ("type",))])
+    # the first staged enrollment of every (user, course, type) of a
+    # pull, of courses and sections we have, that came with its user
+    first_enrollments = (
+        f"WITH e AS (SELECT {doc} AS doc, r.id AS staged_id, "
+        f"ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY r.id) AS n "
+        f"FROM {source} AND {course_id} IN (SELECT id FROM {table(Course)}) "
+        f"AND {section_id} IN (SELECT id FROM {table(CourseSection)}) "
+        f"AND {is_object(doc, 'user')} AND {skip}) ")
+    params = params + skip_params
+
+    user_id = field("doc", "int", ("user", "id"))
+    users = execute(upsert_sql(
+        User, user_columns, first_enrollments +
+        f"SELECT {select(user_columns, 'doc')} FROM "
+        f"(SELECT doc, ROW_NUMBER() OVER (PARTITION BY {user_id} "
+        f"ORDER BY staged_id) AS u FROM e WHERE n = 1) AS first_users "
+        f"WHERE u = 1"), params)
+
+    enrollment = {c: field("doc", kind, path)
+                  for c, kind, path in enrollment_columns}
+    enrollments = execute(upsert_sql(
+        Enrollment, enrollment_columns, first_enrollments +
+        f"SELECT {select(enrollment_columns, 'doc')} FROM e WHERE n = 1 "
+        f"AND NOT EXISTS (SELECT 1 FROM {table(Enrollment)} x "
+        f"WHERE x.user_id = {enrollment['user_id']} "
+        f"AND x.course_id = {enrollment['course_id']} "
+        f"AND x.type = {enrollment['type']} "
+        f"AND x.id <> {enrollment['id']})"), params)
+    return users, enrollments
+
+
+def staged_texts(pull, model, unchanged=None):
+    """ yields (course id, json text) of the staged objects of one model
+    of a pull, by course id then in staging order """
+    source, params = staged(pull, model, unchanged)
+    course_id = field(doc, "int", ("course_id",))
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(f"SELECT {course_id}, CAST({doc} AS TEXT) FROM {source} "
+                       f"ORDER BY 1, r.id", params)
+        while rows := cursor.fetchmany(1000):
+            yield from rows
+
+
+def upsert_rows(model, columns, rows):
+    """ upsert a list of column tuples (in the order of columns) with
+    multi-row INSERT ... VALUES ... ON CONFLICT statements, returns the
+    number of rows """
+    adapt = [connection.ops.adapt_datetimefield_value if kind == "datetime"
+             else None for _, kind, _ in columns]
+    per_statement = max(1, (connection.features.max_query_params or 10000)
+                        // len(columns))
+    marks = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    for start in range(0, len(rows), per_statement):
+        chunk = rows[start:start + per_statement]
+        params = [a(value) if a else value
+                  for row in chunk for a, value in zip(adapt, row)]
+        execute(upsert_sql(model, columns,
+                           "VALUES " + ", ".join([marks] * len(chunk))), params)
+    return len(rows)
@@ -0,0 +1,85 @@
+"""keep the CourseSummary of every course up to date
+
+at the end of a sync, changed_course_ids() picks the courses whose
+enrollments the pull wrote (only the changed ones, when unchanged
+objects were skipped) plus any course without a summary yet, and
+refresh_course_summaries() aggregates their enrollments, a few hundred
+courses per query, and upserts the results.  a pull that changed a
+handful of courses costs a handful of aggregates, and the first sync
+after the table exists fills it in for every course.
+
+    refresh_course_summaries(changed_course_ids(pull))
+
+"""
+from django.db.models import Count, Max, Sum
+
+from canvas.models import Course, CourseSummary, Enrollment, RawJson
+
+student_type = "StudentEnrollment"
+teacher_type = "TeacherEnrollment"
+active_state = "active"
+courses_per_query = 500
+
+
+def summarize(course_ids):
+    """ unsaved CourseSummary rows for the courses, from their enrollments """
+    summaries = {course_id: CourseSummary(course_id=course_id, counts={})
+                 for course_id in course_ids}
+    groups = Enrollment.objects.filter(course_id__in=course_ids).values(
+        "course_id", "type", "enrollment_state").annotate(
+            number=Count("id"), last_activity_at=Max("last_activity_at"),
+            total_activity_time=Sum("total_activity_time")).order_by()
+    for group in groups:
+        summary = summaries[group["course_id"]]
+        number = group["number"]
+        # json keys are strings, a missing type or state is ""
+        summary.counts.setdefault(group["type"] or "", {})[
+            group["enrollment_state"] or ""] = number
+        summary.enrollments += number
+        if group["enrollment_state"] == active_state:
+            if group["type"] == student_type:
+                summary.students += number
+            elif group["type"] == teacher_type:
+                summary.teachers += number
+        summary.total_activity_time += group["total_activity_time"] or 0
+        last = group["last_activity_at"]
+        if last and (summary.last_activity_at is None
+                     or last > summary.last_activity_at):
+            summary.last_activity_at = last
+    return list(summaries.values())
+
+
+def refresh_course_summaries(course_ids=None):
+    """ rebuild the summaries of course_ids, by default every course,
+    returns the number rebuilt """
+    if course_ids is None:
+        course_ids = Course.objects.values_list("id", flat=True)
+    course_ids = sorted(set(course_ids))
+    update_fields = [f.name for f in CourseSummary._meta.concrete_fields
+                     if not f.primary_key]
+    count = 0
+    for start in range(0, len(course_ids), courses_per_query):
+        existing = Course.objects.filter(
+            id__in=course_ids[start:start + courses_per_query]).values_list(
+                "id", flat=True)
+        summaries = summarize(list(existing))
+        CourseSummary.objects.bulk_create(
+            summaries, update_conflicts=True, unique_fields=["course"],
+            update_fields=update_fields)
+        count += len(summaries)
+    return count
+
+
+def changed_course_ids(pull, unchanged=None):
+    """ ids of the courses with enrollments staged in the pull (leaving
+    out those in the unchanged blobs queryset) and of courses without a
+    summary """
+    staged = RawJson.objects.filter(pull=pull, model="Enrollment")
+    if unchanged is not None:
+        staged = staged.exclude(blob_id__in=unchanged)
+    changed = set(Enrollment.objects.filter(
+        id__in=staged.values("api_id")).values_list(
+            "course_id", flat=True).distinct())
+    changed.update(Course.objects.filter(summary__isnull=True).values_list(
+        "id", flat=True))
+    return changed
@@ -1,5 +1,9 @@
+import asyncio
+import datetime
 import json
-from django.test import TestCase
+import os
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
 
 # Create your tests here.
 class RestJsonTest(TestCase):
@@ -18,3 +22,1072 @@ class RestJsonTest(TestCase):
         
         self.assertEqual(len(records_before), 30)
         self.assertEqual(len(records_after), 33)
+
+
+class AsyncCanvasApiTest(SimpleTestCase):
+    def test_pages_follow_next_link_and_update_budget(self):
+        import httpx
+        import lib.async_canvas
+
+        def handler(request):
+            if request.url.params.get("page") == "1":
+                headers = {"X-Rate-Limit-Remaining": "600",
+                           "Link": '<https://canvas.test/p2?page=2>; rel="next"'}
+                return httpx.Response(200, json=[{"id": 1}], headers=headers)
+            return httpx.Response(200, json=[{"id": 2}],
+                                  headers={"X-Rate-Limit-Remaining": "550"})
+
+        async def run():
+            async with lib.async_canvas.api(
+                    transport=httpx.MockTransport(handler)) as canvas:
+                results = await canvas.gather(canvas.get_course_sections, [7, 8])
+                return results, canvas.budget
+
+        with mock.patch.dict(os.environ, {"DJANVAS_TOKEN": "t"}):
+            results, budget = asyncio.run(run())
+        self.assertEqual(results, [(7, [{"id": 1}, {"id": 2}]),
+                                   (8, [{"id": 1}, {"id": 2}])])
+        self.assertEqual(budget.remaining, 550)
+        self.assertEqual(budget.in_flight, 0)
+        self.assertEqual(budget.allowed(), 9)
+
+
+class ThrottleTest(SimpleTestCase):
+    def response(self, status, body, remaining, cost="1.5"):
+        resp = mock.Mock(status_code=status, links={},
+                         headers={"X-Rate-Limit-Remaining": remaining,
+                                  "X-Request-Cost": cost},
+                         text=json.dumps(body), content=json.dumps(body).encode())
+        resp.json.return_value = body
+        return resp
+
+    def test_throttled_page_is_retried_not_parsed(self):
+        import lib.canvas
+        throttle = lib.canvas.Throttle()
+        responses = [self.response(403, "Rate Limit Exceeded", "0"),
+                     self.response(200, [{"id": 1}], "650")]
+        with mock.patch("lib.canvas.requests.get", side_effect=responses), \
+             mock.patch("lib.canvas.time.sleep") as sleep, \
+             self.assertLogs("lib.canvas", "WARNING"):
+            results = lib.canvas.get_paginated_results(
+                "https://canvas.test/x", {}, throttle=throttle)
+        self.assertEqual(results, [{"id": 1}])
+        state = throttle.state()
+        self.assertEqual(state["throttled"], 1)
+        self.assertEqual(state["requests"], 2)
+        self.assertEqual(state["remaining"], 650)
+        self.assertAlmostEqual(state["avg_cost"], 1.5)
+        self.assertTrue(sleep.called)
+
+    def test_interval_grows_as_bucket_empties(self):
+        import lib.canvas
+        throttle = lib.canvas.Throttle()
+        self.assertEqual(throttle.interval(), 0)
+        intervals = []
+        for remaining in ("700", "400", "200", "100"):
+            throttle.update(self.response(200, [], remaining))
+            intervals.append(throttle.interval())
+        self.assertEqual(intervals, sorted(intervals))
+        self.assertEqual(intervals[0], 0)
+
+    def test_session_carries_auth_and_pool_size(self):
+        import lib.canvas
+        session = lib.canvas.make_session("t0ken", pool_size=12)
+        self.assertEqual(session.headers["Authorization"], "Bearer t0ken")
+        self.assertIn("gzip", session.headers["Accept-Encoding"])
+        self.assertEqual(session.get_adapter("https://canvas.test")._pool_maxsize, 12)
+
+
+def import_sync_command():
+    from canvas.management.commands import sync_canvas_data
+    return sync_canvas_data
+
+
+def mock_canvasapi():
+    """ a stand-in for lib.canvas.api; tests fill in the iter_* methods """
+    canvas = mock.Mock()
+    canvas.throttle.state.return_value = {}
+    canvas.sizer.summary.return_value = {}
+    canvas.cache = None
+    canvas.transport = None
+    canvas.recorder = None
+    return canvas
+
+
+class RawJsonWriterTest(TestCase):
+    def test_duplicates_are_counted_not_raised(self):
+        from canvas.models import Pull, RawJson
+        sync_canvas_data = import_sync_command()
+        pull = Pull.objects.create()
+        with sync_canvas_data.RawJsonWriter(pull, batch_size=2) as writer:
+            for api_id in (1, 2, 2, 3, 1):
+                writer.add("Course", {"id": api_id})
+            writer.add("Enrollment", {"id": 1})
+        self.assertEqual(writer.inserted, 4)
+        self.assertEqual(writer.duplicates, 2)
+        self.assertEqual(RawJson.objects.filter(pull=pull).count(), 4)
+
+
+class MaterializeTest(TestCase):
+    def stage_pull(self, sync_canvas_data, course_name="Intro"):
+        from canvas.models import Pull
+        pull = Pull.objects.create()
+        user = {"id": 10, "name": "Ada", "sortable_name": "Lovelace, Ada"}
+        with sync_canvas_data.RawJsonWriter(pull) as writer:
+            writer.add("Course", {"id": 1, "name": course_name,
+                                  "start_at": "2022-01-10T06:00:00Z"})
+            writer.add("CourseSection", {"id": 100, "course_id": 1,
+                                         "name": "Section 1"})
+            for enrollment_id, course_id in ((1000, 1), (1001, 1), (1002, 2)):
+                writer.add("Enrollment", {"id": enrollment_id, "user_id": 10,
+                                          "course_id": course_id,
+                                          "course_section_id": 100,
+                                          "type": "StudentEnrollment",
+                                          "user": user})
+        return pull
+
+    def test_upsert_dedupes_and_updates(self):
+        from canvas.models import Course, Enrollment, User
+        sync_canvas_data = import_sync_command()
+        for name in ("Intro", "Intro II"):
+            pull = self.stage_pull(sync_canvas_data, name)
+            sync_canvas_data.save_courses(pull)
+            sync_canvas_data.save_course_sections(pull)
+            sync_canvas_data.save_users_and_enrollments(pull)
+        self.assertEqual(Course.objects.get(id=1).name, "Intro II")
+        self.assertEqual(User.objects.count(), 1)
+        # 1001 repeats (user, course, type) and 1002 has no course
+        self.assertEqual(list(Enrollment.objects.values_list("id", flat=True)),
+                         [1000])
+
+    def test_sql_and_python_materialize_the_same_rows(self):
+        from lib.synthetic import SyntheticCanvas
+        from canvas.models import Pull, Course, CourseSection, User, Enrollment
+        sync_canvas_data = import_sync_command()
+        pull = Pull.objects.create()
+        canvas = SyntheticCanvas(courses=4, enrollments_per_course=6, users=8)
+        with mock.patch.object(sync_canvas_data, "canvasapi", canvas):
+            sync_canvas_data.import_raw_json_courses(pull)
+            sync_canvas_data.import_raw_json_sections(pull)
+            sync_canvas_data.import_raw_json_enrollments(pull)
+        # one more enrollment repeating (user, course, type) of another
+        duplicate = dict(canvas.enrollment_json(canvas.course_id(0), 0), id=1)
+        with sync_canvas_data.RawJsonWriter(pull) as writer:
+            writer.add("Enrollment", duplicate)
+        models = (Enrollment, User, CourseSection, Course)
+        rows = {}
+        for how, processes in (("python", 1), ("sql", 1), ("python", 2)):
+            for model in models:
+                model.objects.all().delete()
+            options = {"materialize": how, "processes": processes,
+                       "batch_size": 10}
+            counts = [sync_canvas_data.save_courses(pull, **options),
+                      sync_canvas_data.save_course_sections(pull, **options),
+                      sync_canvas_data.save_users_and_enrollments(pull, **options)]
+            rows[how, processes] = counts, [list(m.objects.order_by("id").values())
+                                            for m in models]
+        self.assertEqual(rows["sql", 1], rows["python", 1])
+        self.assertEqual(rows["python", 2], rows["python", 1])
+        self.assertEqual(rows["sql", 1][0][2],
+                         User.objects.count() + Enrollment.objects.count())
+        self.assertIsNotNone(Course.objects.first().start_at)
+        self.assertFalse(Enrollment.objects.filter(id=1).exists())
+
+
+class RecordTest(SimpleTestCase):
+    def test_records_line_up_with_their_models(self):
+        import lib.canvas
+        from canvas.models import Course, CourseSection, User, Enrollment
+        for record, model in ((lib.canvas.CourseRecord, Course),
+                              (lib.canvas.SectionRecord, CourseSection),
+                              (lib.canvas.UserRecord, User),
+                              (lib.canvas.EnrollmentRecord, Enrollment)):
+            self.assertEqual([name for name, _ in record.columns()],
+                             [f.attname for f in model._meta.concrete_fields])
+
+    def test_enrollment_from_json(self):
+        import lib.canvas
+        from canvas.models import Enrollment
+        record = lib.canvas.EnrollmentRecord.from_json(
+            {"id": 1, "user_id": 2, "course_id": 3, "type": "StudentEnrollment",
+             "updated_at": "2022-01-10T06:00:00Z", "extra": "ignored",
+             "user": {"id": 2, "name": "Ada"}})
+        self.assertEqual(record.key, (2, 3, "StudentEnrollment"))
+        self.assertEqual(record.updated_at.tzinfo, datetime.timezone.utc)
+        self.assertEqual(record.user.name, "Ada")
+        self.assertFalse(hasattr(record, "__dict__"))
+        enrollment = Enrollment(*record.astuple())
+        self.assertEqual((enrollment.user_id, enrollment.updated_at),
+                         (2, record.updated_at))
+        self.assertIsNone(lib.canvas.EnrollmentRecord.from_json({"id": 1}).user)
+
+
+class IncrementalSyncTest(TestCase):
+    def fake_canvas(self, updated_at):
+        canvas = mock_canvasapi()
+        canvas.iter_all_courses.side_effect = lambda start_url: iter(
+            [([{"id": 1, "name": "Intro"}], None)])
+        canvas.iter_course_sections.side_effect = lambda course_id, start_url: iter(
+            [([{"id": 100, "course_id": course_id}], None)])
+        enrollments = [
+            {"id": 1000 + i, "user_id": 10 + i, "course_id": 1,
+             "course_section_id": 100, "type": "StudentEnrollment",
+             "updated_at": updated_at[i], "user": {"id": 10 + i}}
+            for i in range(len(updated_at))]
+        # one enrollment per page
+        canvas.iter_course_enrollments.side_effect = (
+            lambda course_id, states, start_url: iter(
+                [([e], f"page{i + 2}" if i + 1 < len(enrollments) else None)
+                 for i, e in enumerate(enrollments)]))
+        return canvas
+
+    def test_second_pull_only_stages_changes(self):
+        from django.core.management import call_command
+        from canvas.models import Pull, RawJson, Enrollment
+        sync_canvas_data = import_sync_command()
+        first = self.fake_canvas(["2022-01-01T00:00:00Z", "2022-01-02T00:00:00Z"])
+        with mock.patch.object(sync_canvas_data, "canvasapi", first):
+            call_command("sync_canvas_data", incremental=True, verbosity=0)
+        second = self.fake_canvas(["2022-01-01T00:00:00Z", "2022-02-01T00:00:00Z"])
+        with mock.patch.object(sync_canvas_data, "canvasapi", second):
+            call_command("sync_canvas_data", incremental=True,
+                         enrollment_states=["active"], verbosity=0)
+        full, delta = Pull.objects.order_by("id")
+        self.assertFalse(full.incremental)
+        self.assertTrue(delta.incremental)
+        self.assertEqual(str(delta.watermark.date()), "2022-02-01")
+        self.assertEqual(list(RawJson.objects.filter(
+            pull=delta, model="Enrollment").values_list("api_id", flat=True)),
+                         [1001])
+        # sections are asked for again, canvas can't say which changed
+        second.iter_course_sections.assert_called_with(1, start_url=None)
+        second.iter_course_enrollments.assert_called_with(1, states=["active"],
+                                                          start_url=None)
+        self.assertEqual(Enrollment.objects.count(), 2)
+
+    def test_watermark_second_and_activity_changes_are_restaged(self):
+        from django.core.management import call_command
+        from canvas.models import Pull, RawJson, Enrollment
+        sync_canvas_data = import_sync_command()
+        first = self.fake_canvas(["2022-01-01T00:00:00Z", "2022-01-02T00:00:00Z"])
+        with mock.patch.object(sync_canvas_data, "canvasapi", first):
+            call_command("sync_canvas_data", incremental=True, verbosity=0)
+        # 1001 changed again within the watermark's second, 1000 was only
+        # active, which canvas doesn't count as an update
+        second = self.fake_canvas(["2022-01-01T00:00:00Z", "2022-01-02T00:00:00Z"])
+        pages = list(second.iter_course_enrollments.side_effect(1, None, None))
+        pages[0][0][0]["last_activity_at"] = "2022-03-01T00:00:00Z"
+        pages[0][0][0]["total_activity_time"] = 60
+        second.iter_course_enrollments.side_effect = (
+            lambda course_id, states, start_url: iter(pages))
+        with mock.patch.object(sync_canvas_data, "canvasapi", second):
+            call_command("sync_canvas_data", incremental=True, verbosity=0)
+        delta = Pull.objects.order_by("id").last()
+        self.assertEqual(sorted(RawJson.objects.filter(
+            pull=delta, model="Enrollment").values_list("api_id", flat=True)),
+                         [1000, 1001])
+        self.assertEqual(str(delta.watermark.date()), "2022-03-01")
+        self.assertEqual(Enrollment.objects.get(id=1000).total_activity_time, 60)
+
+    def test_new_courses_get_all_their_enrollments(self):
+        from django.core.management import call_command
+        from canvas.models import CourseSummary, Enrollment
+        sync_canvas_data = import_sync_command()
+        first = self.fake_canvas(["2022-01-02T00:00:00Z"])
+        with mock.patch.object(sync_canvas_data, "canvasapi", first):
+            call_command("sync_canvas_data", incremental=True, verbosity=0)
+        # course 2 shows up with enrollments older than the watermark
+        second = self.fake_canvas(["2022-01-02T00:00:00Z"])
+        second.iter_all_courses.side_effect = lambda start_url: iter(
+            [([{"id": 1, "name": "Intro"}, {"id": 2, "name": "New"}], None)])
+        second.iter_course_sections.side_effect = lambda course_id, start_url: iter(
+            [([{"id": 100 * course_id, "course_id": course_id}], None)])
+        second.iter_course_enrollments.side_effect = (
+            lambda course_id, states, start_url: iter([([
+                {"id": 1000 * course_id, "user_id": 10, "course_id": course_id,
+                 "course_section_id": 100 * course_id,
+                 "type": "StudentEnrollment",
+                 "updated_at": "2021-06-01T00:00:00Z", "user": {"id": 10}}],
+                                                         None)]))
+        with mock.patch.object(sync_canvas_data, "canvasapi", second):
+            call_command("sync_canvas_data", incremental=True, verbosity=0)
+        self.assertEqual(sorted(Enrollment.objects.values_list("id", flat=True)),
+                         [1000, 2000])
+        self.assertEqual(CourseSummary.objects.get(course_id=2).enrollments, 1)
+
+    def test_new_sections_of_known_courses_are_staged(self):
+        from django.core.management import call_command
+        from canvas.models import Enrollment
+        sync_canvas_data = import_sync_command()
+        first = self.fake_canvas(["2022-01-01T00:00:00Z"])
+        with mock.patch.object(sync_canvas_data, "canvasapi", first):
+            call_command("sync_canvas_data", incremental=True, verbosity=0)
+        second = self.fake_canvas(["2022-01-01T00:00:00Z", "2022-02-01T00:00:00Z"])
+        second.iter_course_sections.side_effect = lambda course_id, start_url: iter(
+            [([{"id": 100, "course_id": course_id},
+               {"id": 101, "course_id": course_id}], None)])
+        pages = list(second.iter_course_enrollments.side_effect(1, None, None))
+        pages[1][0][0]["course_section_id"] = 101
+        second.iter_course_enrollments.side_effect = (
+            lambda course_id, states, start_url: iter(pages))
+        with mock.patch.object(sync_canvas_data, "canvasapi", second):
+            call_command("sync_canvas_data", incremental=True, verbosity=0)
+        self.assertEqual(Enrollment.objects.get(id=1001).course_section_id, 101)
+
+    def test_dropped_enrollments_are_retried_when_unchanged(self):
+        from django.core.management import call_command
+        from canvas.models import CourseSection, Enrollment
+        sync_canvas_data = import_sync_command()
+        first = self.fake_canvas(["2022-01-01T00:00:00Z"])
+        # the section isn't there yet, so the enrollment is dropped
+        first.iter_course_sections.side_effect = lambda course_id, start_url: iter(
+            [([], None)])
+        for materialize in ("sql", "python"):
+            CourseSection.objects.all().delete()
+            with mock.patch.object(sync_canvas_data, "canvasapi", first):
+                call_command("sync_canvas_data", materialize=materialize,
+                             verbosity=0)
+            self.assertEqual(Enrollment.objects.count(), 0)
+            with mock.patch.object(sync_canvas_data, "canvasapi",
+                                   self.fake_canvas(["2022-01-01T00:00:00Z"])):
+                call_command("sync_canvas_data", materialize=materialize,
+                             verbosity=0)
+            self.assertEqual(Enrollment.objects.count(), 1)
+
+    def test_streaming_pull_with_workers(self):
+        from django.core.management import call_command
+        from canvas.models import Enrollment, User
+        sync_canvas_data = import_sync_command()
+        canvas = self.fake_canvas(["2022-01-01T00:00:00Z"] * 5)
+        with mock.patch.object(sync_canvas_data, "canvasapi", canvas):
+            call_command("sync_canvas_data", stream=True, workers=3,
+                         batch_size=2, verbosity=0)
+        self.assertEqual(Enrollment.objects.count(), 5)
+        self.assertEqual(User.objects.count(), 5)
+
+
+class ResumeTest(TestCase):
+    def test_resume_restarts_from_checkpoints(self):
+        from django.core.management import call_command
+        from canvas.models import Pull, PullProgress, Enrollment
+        sync_canvas_data = import_sync_command()
+        canvas = mock_canvasapi()
+        canvas.iter_all_courses.side_effect = lambda start_url: iter(
+            [([{"id": 1}, {"id": 2}], None)])
+        canvas.iter_course_sections.side_effect = lambda course_id, start_url: iter(
+            [([{"id": 100 + course_id, "course_id": course_id}], None)])
+
+        def enrollment(course_id, page):
+            return {"id": course_id * 10 + page, "user_id": page,
+                    "course_id": course_id, "course_section_id": 100 + course_id,
+                    "type": "StudentEnrollment", "user": {"id": page}}
+
+        def crashing(course_id, states, start_url):
+            yield [enrollment(course_id, 1)], f"course{course_id}/page2"
+            if course_id == 2:
+                raise ConnectionError("network went away")
+            yield [enrollment(course_id, 2)], None
+
+        canvas.iter_course_enrollments.side_effect = crashing
+        with mock.patch.object(sync_canvas_data, "canvasapi", canvas):
+            with self.assertRaises(ConnectionError), \
+                 self.assertLogs("canvas", "ERROR") as logs:
+                call_command("sync_canvas_data", batch_size=1, verbosity=0)
+        self.assertIn("--resume", logs.output[0])
+        pull = Pull.objects.get()
+        self.assertIsNone(pull.finished_at)
+        self.assertEqual(
+            PullProgress.objects.get(pull=pull, course_id=2,
+                                     endpoint="enrollments").next_url,
+            "course2/page2")
+
+        def resumed(course_id, states, start_url):
+            self.assertEqual((course_id, start_url), (2, "course2/page2"))
+            yield [enrollment(course_id, 2)], None
+
+        canvas.reset_mock()
+        canvas.iter_course_enrollments.side_effect = resumed
+        with mock.patch.object(sync_canvas_data, "canvasapi", canvas):
+            call_command("sync_canvas_data", resume=pull.id, verbosity=0)
+        canvas.iter_all_courses.assert_not_called()
+        canvas.iter_course_sections.assert_not_called()
+        pull.refresh_from_db()
+        self.assertIsNotNone(pull.finished_at)
+        self.assertEqual(sorted(Enrollment.objects.values_list("id", flat=True)),
+                         [11, 12, 21, 22])
+
+
+class FetchPerCourseTest(SimpleTestCase):
+    def test_pages_come_back_in_course_order(self):
+        import time
+        sync_canvas_data = import_sync_command()
+
+        def iterate(course_id):
+            for page in range(3):
+                # later courses finish first
+                time.sleep((5 - course_id) / 1000)
+                yield [(course_id, page)]
+
+        pages = list(sync_canvas_data.fetch_per_course(range(5), iterate,
+                                                       workers=3))
+        self.assertEqual([p for _, p in pages],
+                         [[(c, p)] for c in range(5) for p in range(3)])
+
+    def test_worker_errors_reach_the_caller(self):
+        sync_canvas_data = import_sync_command()
+
+        def iterate(course_id):
+            yield [course_id]
+            raise ValueError(course_id)
+
+        with self.assertRaises(ValueError):
+            list(sync_canvas_data.fetch_per_course(range(5), iterate,
+                                                   workers=2))
+
+    def test_closing_early_does_not_hang(self):
+        import threading
+        sync_canvas_data = import_sync_command()
+        started = []
+
+        def iterate(course_id):
+            started.append(course_id)
+            for page in range(4):
+                yield [(course_id, page)]
+
+        def consume():
+            pages = sync_canvas_data.fetch_per_course(range(6), iterate,
+                                                      workers=2)
+            for _ in range(3):
+                next(pages)
+            pages.close()
+
+        consumer = threading.Thread(target=consume, daemon=True)
+        consumer.start()
+        consumer.join(timeout=5)
+        self.assertFalse(consumer.is_alive())
+        self.assertLess(len(started), 6)
+
+
+class ContentHashTest(TestCase):
+    def test_identical_payloads_share_a_blob(self):
+        from canvas.models import Pull, RawJson, RawJsonBlob, Course
+        sync_canvas_data = import_sync_command()
+        for name in ("Intro", "Intro", "Intro II"):
+            pull = Pull.objects.create()
+            with sync_canvas_data.RawJsonWriter(pull) as writer:
+                writer.add("Course", {"name": name, "id": 1})
+            pull.finished_at = pull.ts
+            pull.save()
+        self.assertEqual(RawJson.objects.count(), 3)
+        self.assertEqual(RawJsonBlob.objects.count(), 2)
+        # nothing is unchanged until it's been materialized
+        second = Pull.objects.order_by("id")[1]
+        self.assertEqual(len(list(sync_canvas_data.iter_raw_json_batches(
+            second, "Course", skip_unchanged=True))), 1)
+        Course.objects.create(id=1, name="Intro")
+        # only the changed object is left to materialize
+        batches = list(sync_canvas_data.iter_raw_json_batches(
+            pull, "Course", skip_unchanged=True))
+        self.assertEqual(batches, [[{"id": 1, "name": "Intro II"}]])
+        self.assertEqual(list(sync_canvas_data.iter_raw_json_batches(
+            second, "Course", skip_unchanged=True)), [])
+
+    def test_compaction_moves_inline_json_to_blobs(self):
+        import io
+        from django.core.management import call_command
+        from canvas.models import Pull, RawJson, RawJsonBlob
+        for _ in range(2):
+            RawJson.objects.create(pull=Pull.objects.create(), model="Course",
+                                   api_id=1, json={"name": "Intro", "id": 1})
+        RawJsonBlob.objects.create(hash="orphan", json={})
+        out = io.StringIO()
+        with mock.patch("sys.stdout", out):
+            call_command("compact_raw_json", batch_size=1)
+        self.assertIn("deleted 1 unreferenced blobs", out.getvalue())
+        self.assertEqual(list(RawJson.objects.values_list("json", flat=True)),
+                         [None, None])
+        blob, = RawJsonBlob.objects.all()
+        self.assertEqual(blob.json, {"id": 1, "name": "Intro"})
+        self.assertEqual(RawJson.objects.first().payload, blob.json)
+
+
+class PageSizerTest(SimpleTestCase):
+    def test_slow_or_costly_pages_shrink_fast_ones_grow_back(self):
+        import lib.canvas
+        sizer = lib.canvas.PageSizer(target_time_ms=1000, max_request_cost=10)
+        self.assertEqual(sizer.per_page("enrollments"), 100)
+        sizer.observe("enrollments", 100, 1500, 1)
+        self.assertEqual(sizer.per_page("enrollments"), 50)
+        sizer.observe("enrollments", 50, 300, 20)
+        self.assertEqual(sizer.per_page("enrollments"), 25)
+        sizer.observe("enrollments", 25, 100, 1)
+        sizer.observe("enrollments", 50, 100, 1)
+        sizer.observe("enrollments", 100, 100, 1)
+        self.assertEqual(sizer.per_page("enrollments"), 100)
+        self.assertEqual(sizer.summary()["enrollments"]["sizes_used"],
+                         [25, 50, 100])
+        # other endpoints aren't affected
+        self.assertEqual(sizer.per_page("sections"), 100)
+
+    def test_first_request_asks_for_sized_pages(self):
+        import lib.canvas
+        session = FakeCanvasSession(npages=1)
+        sizer = lib.canvas.PageSizer({"sections": 40})
+        list(lib.canvas.iter_pages("https://canvas.test/e", session=session,
+                                   endpoint="sections", sizer=sizer))
+        self.assertIn("per_page=40", session.urls[0])
+        self.assertEqual(sizer.summary()["sections"]["results"], 2)
+
+
+class FakeCanvasSession:
+    """ serves numbered (or bookmark) pages of ids like canvas does """
+    def __init__(self, npages, bookmarks=False):
+        self.npages = npages
+        self.bookmarks = bookmarks
+        self.requested = []
+        self.urls = []
+
+    def link(self, page):
+        from urllib.parse import urlencode
+        if self.bookmarks:
+            page = f"bookmark:{page}"
+        return "https://canvas.test/e?" + urlencode({"page": page, "per_page": 2})
+
+    def get(self, url, headers=None, timeout=None):
+        from urllib.parse import parse_qs, urlparse
+        page = parse_qs(urlparse(url).query)["page"][0].replace("bookmark:", "")
+        page = int(page)
+        self.requested.append(page)
+        self.urls.append(url)
+        links = {"current": {"url": self.link(page)}}
+        if page < self.npages:
+            links["next"] = {"url": self.link(page + 1)}
+        links["last"] = {"url": self.link(self.npages)}
+        body = [{"id": page * 10}, {"id": page * 10 + 1}]
+        resp = mock.Mock(status_code=200, links=links, text="",
+                         content=json.dumps(body).encode(),
+                         elapsed=datetime.timedelta(milliseconds=5),
+                         headers={"X-Rate-Limit-Remaining": "700"})
+        resp.json.return_value = body
+        return resp
+
+
+class PrefetchTest(SimpleTestCase):
+    def test_numbered_pages_are_prefetched_in_order(self):
+        import lib.canvas
+        session = FakeCanvasSession(npages=60)
+        pages = list(lib.canvas.iter_pages("https://canvas.test/e",
+                                           session=session, prefetch=4))
+        # no more cap at 50 requests
+        self.assertEqual([results[0]["id"] for results, _ in pages],
+                         [p * 10 for p in range(1, 61)])
+        self.assertEqual(pages[0][1], session.link(2))
+        self.assertEqual(pages[58][1], session.link(60))
+        self.assertIsNone(pages[-1][1])
+        self.assertEqual(sorted(session.requested), list(range(1, 61)))
+
+    def test_bookmarks_are_followed_one_by_one(self):
+        import lib.canvas
+        session = FakeCanvasSession(npages=3, bookmarks=True)
+        pages = list(lib.canvas.iter_pages("https://canvas.test/e",
+                                           session=session, prefetch=4))
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(session.requested, [1, 2, 3])
+
+
+class FakeCanvasServer:
+    """ a local http server with one page of json per path, answering
+    If-None-Match with 304 when the ETag still matches """
+    def __init__(self, pages):
+        import http.server
+        import threading
+        self.pages = pages
+        self.statuses = []
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(fake.pages[self.path.split("?")[0]]).encode()
+                etag = '"%s"' % hash(body)
+                if self.headers.get("If-None-Match") == etag:
+                    fake.statuses.append(304)
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("X-Rate-Limit-Remaining", "699")
+                    self.end_headers()
+                    return
+                fake.statuses.append(200)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ResponseCacheTest(SimpleTestCase):
+    def test_unchanged_pages_come_from_cache_on_304(self):
+        import tempfile
+        import lib.canvas
+        from lib.response_cache import ResponseCache
+        with tempfile.TemporaryDirectory() as tmp, \
+             FakeCanvasServer({"/courses": [{"id": 1}]}) as server:
+            cache = ResponseCache(os.path.join(tmp, "cache.sqlite3"))
+            session = lib.canvas.make_session("t")
+            for _ in range(2):
+                results = lib.canvas.get_paginated_results(
+                    server.url + "/courses", session=session, cache=cache)
+                self.assertEqual(results, [{"id": 1}])
+            server.pages["/courses"] = [{"id": 1}, {"id": 2}]
+            results = lib.canvas.get_paginated_results(
+                server.url + "/courses", session=session, cache=cache)
+            self.assertEqual(results, [{"id": 1}, {"id": 2}])
+            self.assertEqual(server.statuses, [200, 304, 200])
+            self.assertEqual(cache.state()["hits"], 1)
+            cache.close()
+
+    def test_least_recently_used_pages_are_evicted(self):
+        import tempfile
+        from lib.response_cache import ResponseCache
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ResponseCache(os.path.join(tmp, "cache.sqlite3"),
+                                  max_bytes=25)
+            for url in ("a", "b", "c"):
+                resp = mock.Mock(status_code=200, content=b"x" * 10,
+                                 headers={"ETag": url})
+                cache.store(url, resp)
+            self.assertEqual(cache.conditional_headers("a"), {})
+            self.assertEqual(cache.conditional_headers("c"),
+                             {"If-None-Match": "c"})
+            self.assertEqual(cache.state()["pages"], 2)
+            cache.close()
+
+
+class ReplayTest(TestCase):
+    def write_archive(self, path, pages):
+        """ an archive with one recorded 200 response per url """
+        import gzip
+        with gzip.open(path, "wt") as f:
+            for url, body in pages.items():
+                f.write(json.dumps({"url": url, "status": 200, "headers": {},
+                                    "body": json.dumps(body)}) + "\n")
+
+    def test_recorded_pages_replay_without_network(self):
+        import tempfile
+        import lib.canvas
+        from lib.replay import Recorder, ReplayAdapter
+        with tempfile.TemporaryDirectory() as tmp, \
+             FakeCanvasServer({"/courses": [{"id": 1}]}) as server:
+            path = os.path.join(tmp, "pull.jsonl.gz")
+            recorder = Recorder(path)
+            session = lib.canvas.make_session("t", recorder=recorder)
+            recorded = lib.canvas.get_paginated_results(
+                server.url + "/courses", session=session)
+            recorder.close()
+            server.pages["/courses"] = []
+            replay = ReplayAdapter(path)
+            session = lib.canvas.make_session("", transport=replay)
+            replayed = lib.canvas.get_paginated_results(
+                server.url + "/courses", session=session)
+        self.assertEqual(recorded, [{"id": 1}])
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(server.statuses, [200])
+        self.assertEqual(replay.state()["requests"], 1)
+
+    def test_simulated_bucket_throttles_then_refills(self):
+        import requests
+        from lib.replay import ReplayAdapter
+        url = "https://canvas.test/courses"
+        replay = ReplayAdapter({url: {"url": url, "status": 200,
+                                      "headers": {"X-Request-Cost": "60"},
+                                      "body": "[]"}},
+                               bucket_size=100, leak_rate=0)
+        session = requests.Session()
+        session.mount("https://", replay)
+        statuses = [session.get(url).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 403, 403])
+        replay.leak_rate = 1000000
+        self.assertEqual(session.get(url).status_code, 200)
+        self.assertEqual(replay.state()["throttled"], 2)
+
+    def test_replay_ignores_page_size_and_raises_on_unrecorded_urls(self):
+        import requests
+        from lib.replay import ReplayAdapter
+        url = "https://canvas.test/courses"
+        second = f"{url}?page=2&per_page=100"
+        replay = ReplayAdapter({
+            f"{url}?page=1&per_page=100": {
+                "url": f"{url}?page=1&per_page=100", "status": 200,
+                "headers": {"Link": f'<{second}>; rel="next"'},
+                "body": '[{"id": 1}]'},
+            second: {"url": second, "status": 200, "headers": {},
+                     "body": '[{"id": 2}]'}})
+        session = requests.Session()
+        session.mount("https://", replay)
+        first = session.get(f"{url}?per_page=50&page=1")
+        self.assertEqual(first.json(), [{"id": 1}])
+        self.assertEqual(first.links["next"]["url"], second)
+        with self.assertRaises(LookupError):
+            session.get(f"{url}/7/sections?per_page=100&page=1")
+
+    def test_sync_runs_from_an_archive_without_a_token(self):
+        import tempfile
+        import lib.canvas
+        from django.core.management import call_command
+        from canvas.models import Course, Enrollment
+        courses = f"{lib.canvas.base_url}{lib.canvas.courses_api_path}"
+        query = "?per_page=100&page=1"
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "pull.jsonl.gz")
+            self.write_archive(path, {
+                courses + query: [{"id": 5, "name": "Replayed",
+                                   "course_code": "R1",
+                                   "start_at": "2022-01-10T00:00:00Z",
+                                   "workflow_state": "available",
+                                   "uuid": "u5"}],
+                f"{courses}/5/sections{query}": [
+                    {"id": 6, "course_id": 5, "name": "Section 6"}],
+                f"{courses}/5/enrollments{query}": [
+                    {"id": 9, "type": "StudentEnrollment", "user_id": 3,
+                     "course_id": 5, "course_section_id": 6,
+                     "updated_at": "2022-01-11T00:00:00Z",
+                     "user": {"id": 3, "name": "A Student",
+                              "sortable_name": "Student, A",
+                              "short_name": "A"}}]})
+            sync_canvas_data = import_sync_command()
+            with mock.patch.dict(os.environ, {"DJANVAS_TOKEN": ""}), \
+                 mock.patch.object(sync_canvas_data, "canvasapi", None):
+                call_command("sync_canvas_data", replay=path, verbosity=0)
+        self.assertEqual(Course.objects.get(id=5).name, "Replayed")
+        self.assertEqual(Enrollment.objects.get().user_id, 3)
+        from canvas.models import Pull
+        report = Pull.objects.get().report
+        self.assertEqual([s["stage"] for s in report["stages"]][:3],
+                         ["stage courses", "stage sections", "stage enrollments"])
+        self.assertEqual(report["total"]["http_requests"], 3)
+        self.assertGreater(report["total"]["http_bytes"], 0)
+
+    def test_record_refuses_a_response_cache(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        with self.assertRaisesMessage(CommandError, "--cache"):
+            call_command("sync_canvas_data", record="pull.jsonl.gz",
+                         cache="cache.sqlite3", verbosity=0)
+
+    def test_a_replaying_client_is_not_reused(self):
+        from django.core.management import call_command
+        sync_canvas_data = import_sync_command()
+        replayed = mock_canvasapi()
+        replayed.transport = mock.Mock()
+        fresh = mock_canvasapi()
+        fresh.iter_all_courses.return_value = iter([])
+        with mock.patch.object(sync_canvas_data, "canvasapi", replayed), \
+             mock.patch.object(sync_canvas_data, "connect",
+                               return_value=fresh) as connect:
+            call_command("sync_canvas_data", verbosity=0)
+            self.assertIs(sync_canvas_data.canvasapi, fresh)
+        connect.assert_called_once()
+        replayed.iter_all_courses.assert_not_called()
+
+
+class BenchmarkTest(TestCase):
+    def test_synthetic_pages_resume_from_next_url(self):
+        from lib.synthetic import SyntheticCanvas
+        canvas = SyntheticCanvas(courses=3, enrollments_per_course=5,
+                                 per_page=2)
+        pages = list(canvas.iter_course_enrollments(canvas.course_id(0)))
+        self.assertEqual([len(page) for page, _ in pages], [2, 2, 1])
+        resumed = list(canvas.iter_course_enrollments(
+            canvas.course_id(0), start_url=pages[0][1]))
+        self.assertEqual(resumed, pages[1:])
+        self.assertEqual(pages[0][0][0], canvas.enrollment_json(canvas.course_id(0), 0))
+
+    def test_benchmark_rolls_back_unless_kept(self):
+        import io
+        from django.core.management import call_command
+        from canvas.models import Course, Enrollment
+        out = io.StringIO()
+        with mock.patch("sys.stdout", out):
+            call_command("benchmark_sync", courses=[3],
+                         enrollments_per_course=4)
+        self.assertIn("save users and enrollments", out.getvalue())
+        self.assertEqual(Course.objects.count(), 0)
+        with mock.patch("sys.stdout", io.StringIO()):
+            call_command("benchmark_sync", courses=[3],
+                         enrollments_per_course=4, keep=True)
+        self.assertEqual(Course.objects.count(), 3)
+        self.assertTrue(Enrollment.objects.exists())
+
+    def test_query_benchmark_compares_indexes_and_leaves_no_trace(self):
+        import io
+        from django.core.management import call_command
+        from django.db import connection
+        from canvas.models import Course
+        out = io.StringIO()
+        with mock.patch("sys.stdout", out):
+            call_command("benchmark_queries", courses=4,
+                         enrollments_per_course=3, repeat=1, plans=True)
+        self.assertIn("USING INDEX course_start_at_idx", out.getvalue())
+        self.assertIn("staged enrollment batch", out.getvalue())
+        self.assertEqual(Course.objects.count(), 0)
+        with connection.cursor() as cursor:
+            self.assertIn("course_start_at_idx", connection.introspection.get_constraints(
+                cursor, Course._meta.db_table))
+
+
+class MetricsTest(TestCase):
+    def test_stage_counts_queries_and_http_even_when_it_fails(self):
+        import lib.canvas
+        from canvas.metrics import PullMetrics
+        from canvas.models import Pull
+        throttle = lib.canvas.Throttle()
+        metrics = PullMetrics(throttle)
+        with metrics.stage("save") as stage:
+            stage["rows"] = 2
+            Pull.objects.create()
+            Pull.objects.create()
+            throttle.wait()
+            throttle.update(mock.Mock(headers={}, content=b"[1, 2]"))
+        with self.assertRaises(ValueError):
+            with metrics.stage("broken"):
+                raise ValueError
+        save, broken = metrics.report()["stages"]
+        self.assertEqual((save["queries"], save["rows"]), (2, 2))
+        self.assertEqual((save["http_requests"], save["http_bytes"]), (1, 6))
+        self.assertTrue(broken["failed"])
+        self.assertEqual(metrics.totals()["queries"], 2)
+        self.assertIn("broken (failed)", metrics.table())
+
+    def test_queries_of_other_threads_are_counted(self):
+        import threading
+        from django.db import connection
+        from canvas.metrics import PullMetrics
+
+        def query():
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            finally:
+                connection.close()
+
+        metrics = PullMetrics()
+        with metrics.stage("threads"):
+            threads = [threading.Thread(target=query) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        query_thread = threading.Thread(target=query)
+        query_thread.start()
+        query_thread.join()
+        self.assertEqual(metrics.report()["stages"][0]["queries"], 2)
+
+
+class CodecTest(SimpleTestCase):
+    def test_codecs_agree_on_canonical_text(self):
+        import lib.codec
+        obj = {"b": [1.5, 1e16, 1e-05, 0.1], "a": "Zoë", "id": 2**70,
+               "user": {"name": "Ada", "id": 73770000000000001}}
+        texts = {name: lib.codec.get_codec(name).canonical(obj)
+                 for name in lib.codec.codecs}
+        self.assertEqual(set(texts.values()), {json.dumps(
+            obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)})
+        for name in lib.codec.codecs:
+            codec = lib.codec.get_codec(name)
+            self.assertEqual(codec.loads(codec.dumps(obj).encode()), obj)
+
+    def test_timestamps_are_parsed_aware(self):
+        from lib.codec import parse_datetime
+        self.assertEqual(parse_datetime("2022-01-10T06:00:00Z"),
+                         datetime.datetime(2022, 1, 10, 6,
+                                           tzinfo=datetime.timezone.utc))
+        self.assertIsNone(parse_datetime(""))
+        self.assertIsNone(parse_datetime(None))
+
+    def test_benchmark_reports_every_codec(self):
+        import io
+        from django.core.management import call_command
+        import lib.codec
+        out = io.StringIO()
+        with mock.patch("sys.stdout", out):
+            call_command("benchmark_codec", enrollments=200, repeat=1)
+        self.assertIn("content hashes", out.getvalue())
+        for name in lib.codec.codecs:
+            self.assertIn(name, out.getvalue())
+
+
+class LoggingTest(SimpleTestCase):
+    def test_tokens_are_redacted_and_rows_sampled(self):
+        import logging
+        import lib.logs
+        logger = logging.getLogger("canvas.tests.logging")
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        handler.addFilter(lib.logs.RedactTokens())
+        logger.addHandler(handler)
+        sample = lib.logs.SampleFilter(3)
+        logger.addFilter(sample)
+        try:
+            with mock.patch.dict(os.environ, {"DJANVAS_TOKEN": "s3cret"}), \
+                 lib.logs.queued("canvas.tests.logging"):
+                for i in range(7):
+                    logger.debug("headers %s", {"Authorization": "Bearer s3cret",
+                                                "row": i})
+                logger.removeFilter(sample)
+                logger.info("token is s3cret")
+        finally:
+            logger.removeHandler(handler)
+            logger.removeFilter(sample)
+        messages = [r.getMessage() for r in records]
+        self.assertEqual(len(messages), 4)
+        self.assertTrue(all("s3cret" not in m for m in messages))
+        self.assertIn("'row': 3", messages[1])
+        self.assertEqual(messages[-1], "token is [redacted]")
+        self.assertEqual(logger.handlers, [])
+
+
+class CoursesApiTest(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        from canvas.models import Course
+        cache.clear()
+        for i in range(3):
+            Course.objects.create(
+                id=73770000000000001 + i, name=f"Course {i}", account_id=7,
+                start_at=datetime.datetime(2022, 1, 1 + i,
+                                           tzinfo=datetime.timezone.utc))
+
+    def test_pages_fields_and_string_ids(self):
+        resp = self.client.get("/courses-json/?per_page=2&fields=id,name")
+        self.assertEqual(resp.json(), [{"id": "73770000000000003", "name": "Course 2"},
+                                       {"id": "73770000000000002", "name": "Course 1"}])
+        self.assertIn("page=2", resp["Link"])
+        resp = self.client.get("/courses-json/?per_page=2&page=2")
+        self.assertEqual([c["id"] for c in resp.json()], ["73770000000000001"])
+        self.assertEqual(resp.json()[0]["account_id"], "7")
+        self.assertIn('rel="prev"', resp["Link"])
+        self.assertEqual(self.client.get("/courses-json/?fields=grades").status_code, 400)
+
+    def test_etag_gives_304_until_a_pull_finishes(self):
+        from django.utils import timezone
+        from canvas.models import Course, Pull
+        resp = self.client.get("/courses-json/")
+        etag = resp["ETag"]
+        Course.objects.filter(name="Course 0").update(name="Renamed")
+        with self.assertNumQueries(1):
+            resp = self.client.get("/courses-json/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(self.client.head(
+            "/courses-json/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.head("/courses-json/").status_code, 200)
+        # cached until the next pull finishes
+        self.assertNotIn("Renamed", self.client.get("/courses-json/").content.decode())
+        Pull.objects.create(finished_at=timezone.now())
+        resp = self.client.get("/courses-json/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Renamed", resp.content.decode())
+
+
+class CourseSummaryTest(TestCase):
+    def setUp(self):
+        from canvas.models import Course, CourseSection, User, Enrollment
+        for course_id in (1, 2):
+            course = Course.objects.create(id=course_id, name=f"Course {course_id}")
+            CourseSection.objects.create(id=course_id, course=course)
+        for user_id, course_id, type, state, last in (
+                (10, 1, "StudentEnrollment", "active", 5),
+                (11, 1, "StudentEnrollment", "invited", None),
+                (12, 1, "TeacherEnrollment", "active", 9)):
+            User.objects.get_or_create(id=user_id)
+            Enrollment.objects.create(
+                id=user_id * 100 + course_id, user_id=user_id,
+                course_id=course_id, course_section_id=course_id, type=type,
+                enrollment_state=state, total_activity_time=60,
+                last_activity_at=last and datetime.datetime(
+                    2022, 1, last, tzinfo=datetime.timezone.utc))
+
+    def test_summaries_aggregate_enrollments(self):
+        from canvas.models import CourseSummary
+        from canvas.summaries import refresh_course_summaries
+        self.assertEqual(refresh_course_summaries(), 2)
+        summary = CourseSummary.objects.get(course_id=1)
+        self.assertEqual((summary.enrollments, summary.students, summary.teachers),
+                         (3, 1, 1))
+        self.assertEqual(summary.counts, {"StudentEnrollment": {"active": 1, "invited": 1},
+                                          "TeacherEnrollment": {"active": 1}})
+        self.assertEqual(summary.last_activity_at.day, 9)
+        self.assertEqual(summary.total_activity_time, 180)
+        self.assertEqual(CourseSummary.objects.get(course_id=2).enrollments, 0)
+
+    def test_only_changed_courses_are_refreshed(self):
+        from canvas.models import CourseSummary, Enrollment, Pull, RawJson
+        from canvas.summaries import changed_course_ids, refresh_course_summaries
+        pull = Pull.objects.create()
+        self.assertEqual(changed_course_ids(pull), {1, 2})
+        refresh_course_summaries(changed_course_ids(pull))
+        RawJson.objects.create(pull=pull, model="Enrollment", api_id=1101)
+        self.assertEqual(changed_course_ids(pull), {1})
+        Enrollment.objects.filter(id=1101).update(enrollment_state="active")
+        refresh_course_summaries(changed_course_ids(pull))
+        self.assertEqual(CourseSummary.objects.get(course_id=1).students, 2)
+
+    def test_views_read_the_summary(self):
+        from canvas.summaries import refresh_course_summaries
+        refresh_course_summaries()
+        with self.assertNumQueries(2):
+            resp = self.client.get("/courses/")
+        self.assertContains(resp, "1 students, 1 teachers")
+        resp = self.client.get("/courses-json/?fields=id,students,enrollment_counts")
+        self.assertEqual(resp.json()[0], {
+            "id": "1", "students": 1, "enrollment_counts": {
+                "StudentEnrollment": {"active": 1, "invited": 1},
+                "TeacherEnrollment": {"active": 1}}})
+
+
+class EnrollmentListTest(TestCase):
+    def setUp(self):
+        from canvas.models import Course, CourseSection, Enrollment, User
+        course = Course.objects.create(id=1, name="Roster")
+        section = CourseSection.objects.create(id=2, course=course, name="S1")
+        for i, name in enumerate(["Cee, A", None, "Bee, A", "Bee, A", "Ay, A"]):
+            user = User.objects.create(id=10 + i, name=f"user {i}",
+                                       sortable_name=name)
+            Enrollment.objects.create(id=100 + i, user=user, course=course,
+                                      course_section=section,
+                                      type="StudentEnrollment")
+
+    def test_roster_pages_in_constant_queries(self):
+        from canvas.views import CourseEnrollmentListView
+        seen = []
+        url = "/course-enrollments/1/"
+        with mock.patch.object(CourseEnrollmentListView, "page_size", 2):
+            while url:
+                with self.assertNumQueries(2):
+                    resp = self.client.get(url)
+                self.assertContains(resp, "S1")
+                seen += [e.id for e in resp.context["object_list"]]
+                next_page = resp.context.get("next_page")
+                url = f"/course-enrollments/1/{next_page}" if next_page else None
+        self.assertEqual(seen, [101, 104, 102, 103, 100])
+
+    def test_unknown_course_is_404(self):
+        self.assertEqual(self.client.get("/course-enrollments/9/").status_code, 404)
@@ -1,10 +1,38 @@
-from django.shortcuts import render
+from django.shortcuts import get_object_or_404, render
 from django.views.generic.list import ListView
-from django.http import HttpResponse, HttpResponseNotFound, JsonResponse, Http404
+from django.http import HttpResponse, JsonResponse
 import datetime
+import hashlib
+import json
+from urllib.parse import urlencode
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
+from django.views.decorators.http import condition, require_safe
 
-from canvas.models import Course, Enrollment
+from canvas.models import Course, Enrollment, Pull
+
+# the courses api serves every concrete field, and the course's
+# CourseSummary under these names, unless ?fields= picks some
+course_api_summary_fields = {
+    "enrollments": "summary__enrollments",
+    "students": "summary__students",
+    "teachers": "summary__teachers",
+    "enrollment_counts": "summary__counts",
+    "last_activity_at": "summary__last_activity_at",
+    "total_activity_time": "summary__total_activity_time",
+}
+course_api_fields = ([f.attname for f in Course._meta.concrete_fields]
+                     + list(course_api_summary_fields))
+# canvas ids are bigger than javascript's Number.MAX_SAFE_INTEGER
+course_api_string_ids = {"id", "account_id", "enrollment_term_id"}
+course_api_per_page = 100
+course_api_max_per_page = 1000
+course_api_ordering = ["-start_at", "name", "id"]
+# pages only change with a new pull, which changes the key anyway
+course_api_cache_seconds = 24 * 60 * 60
 
 def current_datetime(request):
     now = datetime.datetime.now()
@@ -18,6 +46,8 @@ async def async_datetime(request):
 
 class CourseListView(ListView):
     model = Course
+    # the enrollment stats come precomputed in the same query
+    queryset = Course.objects.select_related("summary")
     paginate_by = 100
     ordering = ['-start_at']
     def get_context_data(self, **kwargs):
@@ -25,24 +55,54 @@ class CourseListView(ListView):
         context['now'] = timezone.now()
         return context
 
+def course_roster(course, after=""):
+    """ the enrollments of a course by sortable name (users and sections
+    joined in), starting after the ID:NAME keyset cursor if given """
+    enrollments = Enrollment.objects.filter(course=course).select_related(
+        "user", "course_section").annotate(
+            sort_name=Coalesce("user__sortable_name", Value(""))).order_by(
+                "sort_name", "id")
+    after_id, _, after_name = after.partition(":")
+    if after_id.isdigit():
+        enrollments = enrollments.filter(
+            Q(sort_name__gt=after_name) |
+            Q(sort_name=after_name, id__gt=int(after_id)))
+    return enrollments
+
+
 class CourseEnrollmentListView(ListView):
+    """ the roster of a course, by sortable name
+
+    paged with a keyset instead of an offset: ?after=ID:NAME is the
+    enrollment id and user sortable_name of the last row shown, and the
+    next page is the rows sorting after it, so every page costs the
+    same however deep it is.  the course and the page (with users and
+    sections joined in) are one query each
+    """
     model = Enrollment
-    paginate_by = 100
-    #ordering = ['-start_at']
+    template_name = "canvas/enrollment_list.html"
+    page_size = 100
+
+    def get_queryset(self):
+        self.course = get_object_or_404(Course, id=self.kwargs['course_id'])
+        page = list(course_roster(self.course, self.request.GET.get("after", ""))[
+            :self.page_size + 1])
+        self.has_next = len(page) > self.page_size
+        return page[:self.page_size]
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["object_list"] = Enrollment.objects.filter(
-            course=self.kwargs['course_id']).order_by("user__sortable_name", )
-        try:
-            context["course"] = context["object_list"][0].course
-        except IndexError:
-            raise Http404("no enrollments found for the class")
+        context["course"] = self.course
+        if self.has_next:
+            last = self.object_list[-1]
+            context["next_page"] = "?" + urlencode(
+                {"after": f"{last.id}:{last.sort_name}"})
+        context["is_first_page"] = "after" not in self.request.GET
         return context
-    def process_exception(self, request, exception):
-        return HttpResponseNotFound("sorry, there was an error with that request")
 
 class HomeView(ListView):
     model = Course
+    queryset = Course.objects.select_related("summary")
     paginate_by = 100
     ordering = ['-start_at']
     def get_context_data(self, **kwargs):
@@ -50,15 +110,102 @@ class HomeView(ListView):
         context['now'] = timezone.now()
         return context
 
+class CourseApiQuery:
+    """ the page, per_page and fields of a courses api request """
+    def __init__(self, request):
+        params = request.GET
+        self.error = None
+        self._etag = None
+        try:
+            self.page = max(1, int(params.get("page", 1)))
+            self.per_page = min(max(1, int(params.get("per_page",
+                                                      course_api_per_page))),
+                                course_api_max_per_page)
+        except ValueError:
+            self.error = "page and per_page must be numbers"
+            return
+        self.fields = [f for f in params.get("fields", "").split(",") if f] \
+            or course_api_fields
+        unknown = [f for f in self.fields if f not in course_api_fields]
+        if unknown:
+            self.error = f"unknown fields {', '.join(unknown)}"
+
+    def params(self, page):
+        params = {"page": page, "per_page": self.per_page}
+        if self.fields != course_api_fields:
+            params["fields"] = ",".join(self.fields)
+        return urlencode(params)
+
+    def etag(self):
+        """ changes whenever a pull finishes or the query does """
+        if self._etag is None:
+            pull_id = Pull.objects.filter(finished_at__isnull=False).order_by(
+                "-finished_at").values_list("id", flat=True).first() or 0
+            self._etag = hashlib.sha1(
+                f"{pull_id}?{self.params(self.page)}".encode()).hexdigest()
+        return self._etag
+
+
+def course_api_page(query):
+    """ (json body, has next page) for one page of courses, ids as strings,
+    with the fields of the course summary joined in if asked for """
+    offset = (query.page - 1) * query.per_page
+    courses = Course.objects.annotate(**{
+        name: F(lookup) for name, lookup in course_api_summary_fields.items()
+        if name in query.fields})
+    rows = list(courses.order_by(*course_api_ordering).values(
+        *query.fields)[offset:offset + query.per_page + 1])
+    for row in rows:
+        for field in course_api_string_ids.intersection(row):
+            if row[field] is not None:
+                row[field] = str(row[field])
+    more = len(rows) > query.per_page
+    return json.dumps(rows[:query.per_page], cls=DjangoJSONEncoder), more
+
+
+def course_api_query(request):
+    """ the request's CourseApiQuery, parsed once for the etag and the view """
+    if not hasattr(request, "course_api_query"):
+        request.course_api_query = CourseApiQuery(request)
+    return request.course_api_query
+
+
+def courses_etag(request):
+    query = course_api_query(request)
+    return None if query.error else query.etag()
+
+
+@require_safe
+@condition(etag_func=courses_etag)
 def courses_json(request):
-    data = Course.objects.all().values().order_by("-start_at", "name", )
-    for d in data:
-        for attribute in d:
-            print(attribute, type(d[attribute]))
-            if attribute.endswith("id") and type(d[attribute]) is int:
-                d[attribute] = str(d[attribute]) # don't you love javascript?
-    print(data)
-    return JsonResponse(list(data), safe=False)
+    """ a page of courses as a json list, newest first
+
+    ?page=N&per_page=N (at most course_api_max_per_page) pick the page,
+    with canvas style next/prev links in the Link header, and
+    ?fields=id,name picks the fields.  ids are strings.  every page is
+    cached until the next pull finishes, and its ETag lets clients get
+    a 304 instead
+    """
+    query = course_api_query(request)
+    if query.error:
+        return JsonResponse({"error": query.error}, status=400)
+    key = f"courses-json:{query.etag()}"
+    cached = cache.get(key)
+    if cached is None:
+        cached = course_api_page(query)
+        cache.set(key, cached, course_api_cache_seconds)
+    body, more = cached
+    response = HttpResponse(body, content_type="application/json")
+    links = []
+    if more:
+        links.append(f'<{request.path}?{query.params(query.page + 1)}>; rel="next"')
+    if query.page > 1:
+        links.append(f'<{request.path}?{query.params(query.page - 1)}>; rel="prev"')
+    if links:
+        response["Link"] = ", ".join(links)
+    # always revalidate, which is cheap thanks to the ETag
+    response["Cache-Control"] = "no-cache"
+    return response
 
 def d3(request):
     return render(request, 'd3.html')
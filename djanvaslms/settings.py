@@ -153,3 +153,44 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 CELERY_BROKER_URL = 'redis://localhost:6379'
+
+
+# Logging
+# https://docs.djangoproject.com/en/3.0/topics/logging/
+# the sync command sets the level of the lib and canvas loggers from
+# its --verbosity; bearer tokens are scrubbed from every record
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'redact_tokens': {
+            '()': 'lib.logs.RedactTokens',
+        },
+    },
+    'formatters': {
+        'sync': {
+            'format': '%(asctime)s %(levelname)s %(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'stream': 'ext://sys.stdout',
+            'formatter': 'sync',
+            'filters': ['redact_tokens'],
+        },
+    },
+    'loggers': {
+        'lib': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'canvas': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -0,0 +1,158 @@
+"""async counterpart to lib.canvas.api
+
+same get_all_courses/get_course_sections/get_course_enrollments
+surface, but built on httpx.AsyncClient so many paginated streams can
+run at once.  instead of sleeping a fixed normal_sleep_time_ms between
+pages, all streams share one RateLimitBudget that follows the
+X-Rate-Limit-Remaining header and lets more requests through when
+there's headroom and fewer when there isn't.
+
+cf https://canvas.instructure.com/doc/api/file.throttling.html
+"""
+import asyncio
+import logging
+import os
+
+import httpx
+
+import lib.codec
+from lib.canvas import (base_url, token_env_var, per_page, courses_api_path,
+                        max_retries, backoff_time_ms, is_throttled)
+
+# canvas charges every request a 50 unit "pre-flight" penalty up front
+# out of a bucket of 700, so that's roughly how many we can have in flight
+preflight_cost = 50
+max_concurrency = 16
+# below this many units left, stop adding requests and let the bucket refill
+low_water_mark = 100
+refill_sleep_time_ms = 500
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitBudget:
+    """ one throttling budget shared by every request of an async api
+
+    the number of requests allowed in flight is derived from the last
+    X-Rate-Limit-Remaining we saw; before the first response comes back
+    only one request is let through so we learn where we stand
+    """
+    def __init__(self, max_concurrency=max_concurrency,
+                 preflight_cost=preflight_cost, low_water_mark=low_water_mark):
+        self.max_concurrency = max_concurrency
+        self.preflight_cost = preflight_cost
+        self.low_water_mark = low_water_mark
+        self.remaining = None
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    def allowed(self):
+        """ how many requests may be in flight given the last known headroom """
+        if self.remaining is None:
+            return 1
+        if self.remaining <= self.low_water_mark:
+            return 1
+        headroom = self.remaining - self.low_water_mark
+        return max(1, min(self.max_concurrency,
+                          int(headroom // self.preflight_cost)))
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self.in_flight < self.allowed())
+            self.in_flight += 1
+        if self.remaining is not None and self.remaining <= self.low_water_mark:
+            # nearly empty: give the bucket a moment to leak back
+            await asyncio.sleep(refill_sleep_time_ms/1000)
+
+    async def release(self, headers=None):
+        async with self._condition:
+            self.in_flight -= 1
+            if headers is not None and 'X-Rate-Limit-Remaining' in headers:
+                self.remaining = float(headers['X-Rate-Limit-Remaining'])
+            self._condition.notify_all()
+
+
+async def get_paginated_results(client, url, budget, timeout=5):
+    """ async version of lib.canvas.get_paginated_results
+
+    pages of one stream are still fetched in order (each needs the
+    previous page's next link) but any number of streams can share the
+    client and budget
+    """
+    results = []
+    urlplusquery = f"{url}?per_page={per_page}&page=1"
+    retries = 0
+    while True:
+        await budget.acquire()
+        try:
+            resp = await client.get(urlplusquery, timeout=timeout)
+        except BaseException:
+            await budget.release()
+            raise
+        await budget.release(resp.headers)
+        status = resp.status_code
+        if is_throttled(resp):
+            if retries >= max_retries:
+                resp.raise_for_status()
+            delay_ms = backoff_time_ms(retries)
+            logger.warning("throttled, backing off %.0f ms", delay_ms)
+            await asyncio.sleep(delay_ms/1000)
+            retries += 1
+            continue
+        retries = 0
+        if status in (401, 404):
+            return []
+        results.extend(lib.codec.loads(resp.content))
+        if 'next' in resp.links:
+            urlplusquery = resp.links['next']['url']
+            continue
+        break
+    return [r for r in results if isinstance(r, dict)]
+
+
+class api:
+    """ async class to get data from Canvas
+
+    use as an async context manager so the connection pool is closed:
+
+        async with lib.async_canvas.api() as canvas:
+            courses = await canvas.get_all_courses()
+            enrollments = await canvas.gather(canvas.get_course_enrollments,
+                                              [c["id"] for c in courses])
+    """
+    def __init__(self, budget=None, transport=None):
+        self.token = os.environ.get(token_env_var, "")
+        if not self.token:
+            raise RuntimeError(f'no token in "{token_env_var}"')
+        self.budget = budget or RateLimitBudget()
+        self.client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {self.token}"},
+            limits=httpx.Limits(max_connections=self.budget.max_concurrency),
+            transport=transport)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+
+    async def get_all_courses(self):
+        url = f"{base_url}{courses_api_path}"
+        return await get_paginated_results(self.client, url, self.budget)
+
+    async def get_course_sections(self, course_id):
+        url = f"{base_url}{courses_api_path}/{course_id}/sections"
+        return await get_paginated_results(self.client, url, self.budget)
+
+    async def get_course_enrollments(self, course_id):
+        url = f"{base_url}{courses_api_path}/{course_id}/enrollments"
+        return await get_paginated_results(self.client, url, self.budget)
+
+    async def gather(self, fetch, course_ids):
+        """ run fetch for every course concurrently under the shared budget
+
+        returns a list of (course_id, results) in the order of course_ids
+        """
+        results = await asyncio.gather(*(fetch(c) for c in course_ids))
+        return list(zip(course_ids, results))
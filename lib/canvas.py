@@ -1,14 +1,35 @@
-import json
+import dataclasses
+import datetime
+import logging
+import operator
 import os
+import random
 import requests
-import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
+
+import lib.codec
 
 base_url =  "https://canvas.instructure.com/api"
 token_env_var = "DJANVAS_TOKEN"
 per_page = 20
+# canvas won't return more than 100 per page, whatever we ask for.  an
+# endpoint can be pinned to a smaller starting size in endpoint_per_page
+max_per_page = 100
+min_per_page = 10
+endpoint_per_page = {"courses": max_per_page,
+                     "sections": max_per_page,
+                     "enrollments": max_per_page}
 exponential_backoff_start_ms = 1000
-normal_sleep_time_ms = 200
+exponential_backoff_max_ms = 60000
+max_retries = 8
+default_pool_size = 10
+default_prefetch = 4
+
+logger = logging.getLogger(__name__)
 
 version = "v1"
 courses_api_path = f"/{version}/courses"
@@ -23,68 +44,582 @@ skip_course_ids.add(73770000000037256) # instructional continuity resources
 skip_course_ids.add(73770000000028287) # something with >500 pages of enrollments
 skip_course_ids.add(73770000000033834) # strategic planning
 
-def get_paginated_results(url, headers, timeout=5):
-    """ helper function that implements the paginated api query """
-    page = 1
-    results = []
-    nrequests = 0
+def backoff_time_ms(attempt):
+    """ exponential backoff with full jitter for the given retry attempt
+
+    cf https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    """
+    ceiling = min(exponential_backoff_max_ms,
+                  exponential_backoff_start_ms * 2**attempt)
+    return random.uniform(ceiling/2, ceiling)
+
+def is_throttled(resp):
+    """ canvas answers 403 with "Rate Limit Exceeded" when the bucket is empty
+    (as opposed to a 403 for something we aren't allowed to see) """
+    if resp.status_code != 403:
+        return False
+    remaining = resp.headers.get('X-Rate-Limit-Remaining')
+    if remaining is not None and float(remaining) <= 0:
+        return True
+    return "Rate Limit Exceeded" in resp.text
+
+
+class Throttle:
+    """ adaptive request pacing based on canvas's leaky bucket
+
+    canvas reports how much of the bucket is left in
+    X-Rate-Limit-Remaining and what the last request cost in
+    X-Request-Cost.  while there is plenty left we don't wait at all;
+    the interval between requests grows as the bucket empties, and
+    once we're under low_water_mark we wait for it to leak back enough
+    to pay for another average request.  one Throttle is shared by all
+    threads using the same token.
+
+    cf https://canvas.instructure.com/doc/api/file.throttling.html
+    """
+    def __init__(self, bucket_size=700, low_water_mark=150, leak_rate=10,
+                 max_interval_ms=2000):
+        self.bucket_size = bucket_size
+        self.low_water_mark = low_water_mark
+        self.leak_rate = leak_rate # units per second
+        self.max_interval_ms = max_interval_ms
+        self.remaining = None
+        self.last_cost = None
+        self.avg_cost = None
+        self.requests = 0
+        self.throttled = 0
+        self.waited_ms = 0
+        self.bytes = 0 # of response bodies, decompressed
+        self._next_request_at = 0
+        self._lock = threading.Lock()
+
+    def interval(self):
+        """ seconds to leave between requests at the current headroom """
+        if self.remaining is None:
+            return 0
+        if self.remaining <= self.low_water_mark:
+            deficit = self.low_water_mark - self.remaining + (self.avg_cost or 1)
+            return deficit / self.leak_rate
+        used = 1 - min(self.remaining, self.bucket_size) / self.bucket_size
+        return self.max_interval_ms * used**2 / 1000
+
+    def wait(self):
+        """ block until this thread may send its next request """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_request_at)
+            self._next_request_at = start + self.interval()
+            delay = start - now
+            self.requests += 1
+            self.waited_ms += delay * 1000
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, resp):
+        """ record the rate limit headers (and size) of a response """
+        remaining = resp.headers.get('X-Rate-Limit-Remaining')
+        cost = resp.headers.get('X-Request-Cost')
+        size = len(resp.content)
+        with self._lock:
+            self.bytes += size
+            if remaining is not None:
+                self.remaining = float(remaining)
+            if cost is not None:
+                self.last_cost = float(cost)
+                if self.avg_cost is None:
+                    self.avg_cost = self.last_cost
+                else:
+                    self.avg_cost = 0.8 * self.avg_cost + 0.2 * self.last_cost
+
+    def backoff(self, attempt):
+        """ sleep after a throttled response and hold back everyone else too """
+        delay_ms = backoff_time_ms(attempt)
+        logger.warning("throttled, backing off %.0f ms", delay_ms)
+        with self._lock:
+            self.throttled += 1
+            self.waited_ms += delay_ms
+            self._next_request_at = max(self._next_request_at,
+                                        time.monotonic() + delay_ms/1000)
+        time.sleep(delay_ms/1000)
+
+    def state(self):
+        with self._lock:
+            return {"remaining": self.remaining,
+                    "last_cost": self.last_cost,
+                    "avg_cost": self.avg_cost,
+                    "interval_ms": round(self.interval() * 1000, 1),
+                    "requests": self.requests,
+                    "throttled": self.throttled,
+                    "waited_ms": round(self.waited_ms, 1),
+                    "bytes": self.bytes}
+
+
+def make_session(token, pool_size=default_pool_size, transport=None,
+                 recorder=None):
+    """ a keep-alive session shared by every request made with one token
+
+    the authorization header is set once here instead of per call,
+    gzip is asked for explicitly, and the connection pool is big enough
+    for pool_size threads to each hold a connection to canvas.  a
+    transport (e.g. lib.replay.ReplayAdapter) replaces the network, and
+    a recorder (lib.replay.Recorder) gets a copy of every response
+    """
+    session = requests.Session()
+    session.headers.update({"Authorization": f"Bearer {token}",
+                            "Accept-Encoding": "gzip, deflate",
+                            "Connection": "keep-alive"})
+    adapter = transport or requests.adapters.HTTPAdapter(
+        pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if recorder is not None:
+        session.hooks["response"].append(recorder.hook)
+    return session
+
+
+class PageSizer:
+    """ picks per_page for each endpoint from how its pages went so far
+
+    bigger pages mean fewer requests, but canvas bills expensive
+    requests more (X-Request-Cost) and very big pages can run into the
+    request timeout.  each endpoint starts at its endpoint_per_page
+    size; the size is halved when a page takes longer than
+    target_time_ms or costs more than max_request_cost, and doubled
+    back (up to the configured size) when pages come in well under
+    both.  summary() says what was used, per endpoint.
+    """
+    def __init__(self, sizes=None, target_time_ms=2000, max_request_cost=50):
+        self.configured = dict(endpoint_per_page, **(sizes or {}))
+        self.target_time_ms = target_time_ms
+        self.max_request_cost = max_request_cost
+        self.sizes = {}
+        self.stats = {}
+        self._lock = threading.Lock()
 
-    urlplusquery = f"{url}?per_page={per_page}&page={page}"
-    while(True):
-        print(url, headers, file=sys.stderr)
-        print(urlplusquery)
-        resp = requests.get(urlplusquery, headers=headers, timeout=timeout)
+    def per_page(self, endpoint):
+        with self._lock:
+            return self.sizes.get(endpoint,
+                                  self.configured.get(endpoint, per_page))
+
+    def observe(self, endpoint, size, elapsed_ms, cost):
+        with self._lock:
+            stats = self.stats.setdefault(endpoint, {
+                "requests": 0, "results": 0, "avg_ms": None, "avg_cost": None,
+                "sizes_used": set()})
+            stats["requests"] += 1
+            stats["sizes_used"].add(size)
+            for key, value in (("avg_ms", elapsed_ms), ("avg_cost", cost)):
+                if value is None:
+                    continue
+                old = stats[key]
+                stats[key] = value if old is None else 0.8 * old + 0.2 * value
+            ceiling = self.configured.get(endpoint, per_page)
+            current = self.sizes.get(endpoint, ceiling)
+            too_slow = elapsed_ms > self.target_time_ms
+            too_costly = cost is not None and cost > self.max_request_cost
+            if too_slow or too_costly:
+                self.sizes[endpoint] = max(min_per_page, size // 2)
+            elif (elapsed_ms < self.target_time_ms / 2 and
+                  (cost is None or cost < self.max_request_cost / 2)):
+                self.sizes[endpoint] = min(ceiling, max(current, size * 2))
+
+    def count_results(self, endpoint, n):
+        with self._lock:
+            if endpoint in self.stats:
+                self.stats[endpoint]["results"] += n
+
+    def summary(self):
+        with self._lock:
+            return {endpoint: {"per_page": self.sizes.get(
+                                   endpoint, self.configured.get(endpoint, per_page)),
+                               "sizes_used": sorted(stats["sizes_used"]),
+                               "requests": stats["requests"],
+                               "results": stats["results"],
+                               "avg_ms": round(stats["avg_ms"] or 0, 1),
+                               "avg_cost": stats["avg_cost"]}
+                    for endpoint, stats in self.stats.items()}
+
+
+def get_page(session, url, headers=None, timeout=5, throttle=None,
+             cache=None):
+    """ GET one page under the throttle, retrying while canvas says we're
+    over the rate limit.  returns None for 401/404
+
+    with a lib.response_cache.ResponseCache the request is made
+    conditional on what's cached for the url, and a 304 comes back as
+    the cached page """
+    attempt = 0
+    while True:
+        logger.debug("GET %s", url)
+        request_headers = dict(headers or {})
+        if cache is not None:
+            request_headers.update(cache.conditional_headers(url))
+        throttle.wait()
+        resp = session.get(url, headers=request_headers or None,
+                           timeout=timeout)
         status = resp.status_code
-        xratelimitremaining = float(resp.headers.get('X-Rate-Limit-Remaining', 1))
+        throttle.update(resp)
+        if cache is not None:
+            if status == 304:
+                resp = cache.cached_response(url, resp)
+                if resp is None:
+                    # evicted between the two lookups, ask again
+                    continue
+                status = resp.status_code
+            else:
+                cache.store(url, resp)
 
-        print("status ", status, ", xratelimitremaining ", xratelimitremaining,
-              file=sys.stderr)
+        logger.debug("status %s, X-Rate-Limit-Remaining %s", status,
+                     throttle.remaining)
         # be nice
-        if status == 403 and xratelimitremaining == 0:
-            backoff_time_ms = exponential_backoff_start_ms
-            print("backing off ", backoff_time_ms, file=sys.stderr)
-            time.sleep(backoff_time_ms/1000)
-            backoff_time_ms *= 2
+        if is_throttled(resp):
+            if attempt >= max_retries:
+                resp.raise_for_status()
+            throttle.backoff(attempt)
+            attempt += 1
+            continue
         if status == 404:
-            return []
+            return None
         if status == 401:
-            return []
-        results.extend(resp.json())
-        print("\n\n", resp.links, "\n\n")
-        if 'next' in resp.links:
-            urlplusquery = resp.links['next']['url']
-            time.sleep(normal_sleep_time_ms/1000)
-            continue
-        if 'last' not in resp.links:
-             break
-        if resp.links['current']['url'] == resp.links['last']['url']:
-            break
-        #page += 1
-        nrequests += 1
-        if nrequests > 50:
-            break
-    print(f"there were total {len(results)} results before filtering",
-          file=sys.stderr)
+            return None
+        logger.debug("links %s", resp.links)
+        return resp
+
+
+def page_results(resp):
     # check to make sure that each element is a dictionary
-    results = [r for r in results if isinstance(r, dict)]
+    return [r for r in lib.codec.loads(resp.content) if isinstance(r, dict)]
+
+
+class Record:
+    """ base of the slot based records canvas objects are turned into
+    before they're materialized
+
+    from_json reads each field of a response object once, parsing the
+    timestamps, and astuple() gives the fields that are columns of the
+    canvas.models model of the same name, in that model's field order,
+    so the model can be built positionally: Course(*record.astuple()).
+    a record takes a fraction of the memory of the dict it came from
+    """
+    __slots__ = ()
+
+    @classmethod
+    def columns(cls):
+        """ (name, type) of the fields that are model columns, in order """
+        return [(f.name, f.type) for f in dataclasses.fields(cls)
+                if f.metadata.get("column", True)]
+
+
+def record(cls):
+    """ class decorator making a Record subclass a slotted dataclass
+
+    like dataclass(slots=True), which needs python 3.10: the class is
+    made again with a slot per field instead of the class attributes
+    holding the defaults, which __init__ has already """
+    cls = dataclasses.dataclass(cls)
+    names = tuple(f.name for f in dataclasses.fields(cls))
+    namespace = {key: value for key, value in cls.__dict__.items()
+                 if key not in names + ("__dict__", "__weakref__")}
+    namespace["__slots__"] = names
+    cls = type(cls)(cls.__name__, cls.__bases__, namespace)
+    getter = operator.attrgetter(*[name for name, _ in cls.columns()])
+    cls.astuple = lambda self: getter(self)
+    return cls
+
+
+@record
+class CourseRecord(Record):
+    id: int = None
+    name: str = None
+    account_id: int = None
+    uuid: str = None
+    start_at: datetime.datetime = None
+    created_at: datetime.datetime = None
+    course_code: str = None
+    enrollment_term_id: int = None
+    end_at: datetime.datetime = None
+    sis_course_id: str = None
+
+    @classmethod
+    def from_json(cls, obj):
+        get, parse = obj.get, lib.codec.parse_datetime
+        return cls(get('id'), get('name'), get('account_id'), get('uuid'),
+                   parse(get('start_at')), parse(get('created_at')),
+                   get('course_code'), get('enrollment_term_id'),
+                   parse(get('end_at')), get('sis_course_id'))
+
+
+@record
+class SectionRecord(Record):
+    id: int = None
+    course_id: int = None
+    name: str = None
+    start_at: datetime.datetime = None
+    created_at: datetime.datetime = None
+    end_at: datetime.datetime = None
+    sis_course_id: str = None
+    sis_section_id: str = None
+
+    @classmethod
+    def from_json(cls, obj):
+        get, parse = obj.get, lib.codec.parse_datetime
+        return cls(get('id'), get('course_id'), get('name'),
+                   parse(get('start_at')), parse(get('created_at')),
+                   parse(get('end_at')), get('sis_course_id'),
+                   get('sis_section_id'))
+
+
+@record
+class UserRecord(Record):
+    id: int = None
+    name: str = None
+    created_at: datetime.datetime = None
+    sortable_name: str = None
+    short_name: str = None
+    sis_user_id: str = None
+    root_account: str = None
+    login_id: str = None
+
+    @classmethod
+    def from_json(cls, obj):
+        get = obj.get
+        return cls(get('id'), get('name'),
+                   lib.codec.parse_datetime(get('created_at')),
+                   get('sortable_name'), get('short_name'),
+                   get('sis_user_id'), get('root_account'), get('login_id'))
+
+
+@record
+class EnrollmentRecord(Record):
+    """ user is the UserRecord of the enrollment's user object, None when
+    canvas didn't include one (it doesn't unless we teach the course) """
+    id: int = None
+    user_id: int = None
+    course_id: int = None
+    type: str = None
+    created_at: datetime.datetime = None
+    updated_at: datetime.datetime = None
+    course_section_id: int = None
+    enrollment_state: str = None
+    role: str = None
+    role_id: int = None
+    last_activity_at: datetime.datetime = None
+    last_attended_at: datetime.datetime = None
+    total_activity_time: int = None
+    user: UserRecord = dataclasses.field(default=None,
+                                         metadata={"column": False})
+
+    @classmethod
+    def from_json(cls, obj):
+        get, parse = obj.get, lib.codec.parse_datetime
+        user = get('user')
+        return cls(get('id'), get('user_id'), get('course_id'), get('type'),
+                   parse(get('created_at')), parse(get('updated_at')),
+                   get('course_section_id'), get('enrollment_state'),
+                   get('role'), get('role_id'), parse(get('last_activity_at')),
+                   parse(get('last_attended_at')), get('total_activity_time'),
+                   UserRecord.from_json(user) if isinstance(user, dict) else None)
+
+    @property
+    def key(self):
+        """ what the Enrollment unique_together constraint is on """
+        return (self.user_id, self.course_id, self.type)
+
+
+def page_number(url):
+    """ the page= of a canvas pagination link if it's a plain number,
+    None for bookmark style links (page=bookmark:...) """
+    if not url:
+        return None
+    values = parse_qs(urlparse(url).query).get("page")
+    if values and values[0].isdigit():
+        return int(values[0])
+    return None
+
+
+def with_page(url, page):
+    """ url with its page= query parameter replaced """
+    parts = urlparse(url)
+    query = parse_qs(parts.query, keep_blank_values=True)
+    query["page"] = [str(page)]
+    return urlunparse(parts._replace(query=urlencode(query, doseq=True)))
+
+
+def iter_prefetched_pages(urls, prefetch, fetch=get_page, **kwargs):
+    """ fetch urls on prefetch threads, yielding (resp, url) in order
+
+    at most 2*prefetch pages are fetched ahead of the one being yielded
+    """
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        in_flight = deque()
+        for url in urls:
+            in_flight.append((executor.submit(fetch, url=url, **kwargs), url))
+            if len(in_flight) >= 2 * prefetch:
+                future, url = in_flight.popleft()
+                yield future.result(), url
+        while in_flight:
+            future, url = in_flight.popleft()
+            yield future.result(), url
+
+
+def iter_pages(url, headers=None, timeout=5, throttle=None, session=None,
+               params=None, start_url=None, prefetch=1, endpoint=None,
+               sizer=None, cache=None):
+    """ generator that implements the paginated api query
+
+    yields (results, next_url) for each page in order, where next_url
+    is None on the last page.  pass a session from make_session() to
+    reuse connections across pages.  params are extra query parameters
+    for the first page, e.g. {"state[]": ["active", "invited"]}; canvas
+    carries them over into the next links itself.  start_url is a
+    next_url from an earlier run to pick the query back up from, in
+    place of url and params
+
+    when canvas numbers its pages (the next and last links have
+    page=N), every remaining page url is known after the first
+    response, so with prefetch > 1 they are fetched that many at a time.
+    bookmark style links can only be followed one after another
+
+    with a PageSizer, per_page comes from sizer.per_page(endpoint) and
+    every response is reported back to it.  cache is passed on to
+    get_page()
+
+    cf https://canvas.instructure.com/doc/api/file.pagination.html
+    """
+    if session is None:
+        session = requests
+    if throttle is None:
+        throttle = Throttle()
+    page = 1
+    nresults = 0
+    size = sizer.per_page(endpoint) if sizer else per_page
+    if start_url:
+        # a resumed query keeps the page size it was started with
+        sizes = parse_qs(urlparse(start_url).query).get("per_page")
+        if sizes and sizes[0].isdigit():
+            size = int(sizes[0])
+    fetch = dict(session=session, headers=headers, timeout=timeout,
+                 throttle=throttle, cache=cache)
+    if sizer:
+        def get_sized_page(url, **kwargs):
+            resp = get_page(url=url, **kwargs)
+            if resp is not None:
+                cost = resp.headers.get('X-Request-Cost')
+                sizer.observe(endpoint, size,
+                              resp.elapsed.total_seconds() * 1000,
+                              float(cost) if cost is not None else None)
+            return resp
+    else:
+        get_sized_page = get_page
+
+    query = {"per_page": size, "page": page, **(params or {})}
+    urlplusquery = start_url or f"{url}?{urlencode(query, doseq=True)}"
+    while urlplusquery:
+        resp = get_sized_page(url=urlplusquery, **fetch)
+        if resp is None:
+            return
+        urlplusquery = resp.links.get('next', {}).get('url')
+        results = page_results(resp)
+        nresults += len(results)
+        yield results, urlplusquery
+
+        first = page_number(urlplusquery)
+        last = page_number(resp.links.get('last', {}).get('url'))
+        if prefetch > 1 and first and last and last >= first:
+            urls = [with_page(urlplusquery, n) for n in range(first, last + 1)]
+            logger.debug("prefetching pages %s to %s", first, last)
+            for i, (resp, page_url) in enumerate(
+                    iter_prefetched_pages(urls, prefetch, get_sized_page,
+                                          **fetch)):
+                # a missing page means the list shrank under us
+                results = page_results(resp) if resp is not None else []
+                if i + 1 < len(urls):
+                    urlplusquery = urls[i + 1]
+                elif resp is not None:
+                    # the last page may have grown a next link meanwhile
+                    urlplusquery = resp.links.get('next', {}).get('url')
+                else:
+                    urlplusquery = None
+                nresults += len(results)
+                yield results, urlplusquery
+    if sizer:
+        sizer.count_results(endpoint, nresults)
+    logger.debug("there were total %s results", nresults)
+
+
+def iter_paginated_results(url, headers=None, **kwargs):
+    """ yields the results of a paginated api query one page at a time,
+    so callers never need to hold more than a page in memory """
+    for results, next_url in iter_pages(url, headers, **kwargs):
+        yield results
+
+
+def get_paginated_results(url, headers=None, **kwargs):
+    """ helper function that implements the paginated api query """
+    results = []
+    for page in iter_paginated_results(url, headers, **kwargs):
+        results.extend(page)
     return results
 
 
 
 class api:
-    """ general class to get data from Canvas """
-    def __init__(self):
+    """ general class to get data from Canvas
+
+    with a transport (lib.replay.ReplayAdapter) no token is needed, the
+    pages come from a recorded archive instead of canvas
+    """
+    def __init__(self, pool_size=default_pool_size, prefetch=default_prefetch,
+                 cache=None, transport=None, recorder=None):
         self.token = os.environ.get(token_env_var,"")
-        if not self.token:
-            raise CommandError(f'no token in "{token_env_var}"')
+        if not self.token and transport is None:
+            raise RuntimeError(f'no token in "{token_env_var}"')
+        self.transport = transport
+        self.recorder = recorder
+        self.throttle = Throttle()
+        self.session = make_session(self.token, pool_size, transport, recorder)
+        self.prefetch = prefetch
+        self.sizer = PageSizer()
+        self.cache = cache
 
-    def get_all_courses(self):
-        page = 1
-        results = []
-        nrequests = 0
+    def set_pool_size(self, pool_size):
+        """ resize the connection pool, e.g. to match the number of workers """
+        self.session.close()
+        self.session = make_session(self.token, pool_size, self.transport,
+                                    self.recorder)
+
+    def iter_all_courses(self, start_url=None):
+        """ yields (courses, next_url) a page at a time """
         url = f"{base_url}{courses_api_path}"
-        headers = {"Authorization": f"Bearer {self.token}"}
-        courses = get_paginated_results(url, headers)
+        return iter_pages(url, throttle=self.throttle, session=self.session,
+                          start_url=start_url, prefetch=self.prefetch,
+                          endpoint="courses", sizer=self.sizer,
+                          cache=self.cache)
+
+    def iter_course_sections(self, course_id, start_url=None):
+        """ yields (sections, next_url) a page at a time """
+        url = f"{base_url}{courses_api_path}/{course_id}/sections"
+        return iter_pages(url, throttle=self.throttle, session=self.session,
+                          start_url=start_url, prefetch=self.prefetch,
+                          endpoint="sections", sizer=self.sizer,
+                          cache=self.cache)
+
+    def iter_course_enrollments(self, course_id, states=None, start_url=None):
+        """ yields (enrollments, next_url) a page at a time
+
+        states filters on enrollment state, e.g. ["active", "invited"]
+
+        cf https://canvas.instructure.com/doc/api/enrollments.html
+        """
+        url = f"{base_url}{courses_api_path}/{course_id}/enrollments"
+        params = {"state[]": states} if states else None
+        return iter_pages(url, throttle=self.throttle, session=self.session,
+                          params=params, start_url=start_url,
+                          prefetch=self.prefetch, endpoint="enrollments",
+                          sizer=self.sizer, cache=self.cache)
+
+    def get_all_courses(self):
+        courses = [c for page, _ in self.iter_all_courses() for c in page]
 
         # for res in courses:
         #     Print.dumps(res, sort_keys=True, indent=4), sys.stderr)
@@ -95,13 +630,12 @@ class api:
         return courses
 
     def get_course_sections(self, course_id):
-        url = f"{base_url}{courses_api_path}/{course_id}/sections"
-        headers = {"Authorization": f"Bearer {self.token}"}
-        sections  = get_paginated_results(url, headers)
+        sections  = [s for page, _ in self.iter_course_sections(course_id)
+                     for s in page]
         return sections
 
-    def get_course_enrollments(self, course_id):
-        url = f"{base_url}{courses_api_path}/{course_id}/enrollments"
-        headers = {"Authorization": f"Bearer {self.token}"}
-        enrollments  = get_paginated_results(url, headers)
+    def get_course_enrollments(self, course_id, states=None):
+        enrollments  = [e for page, _ in self.iter_course_enrollments(course_id,
+                                                                      states)
+                        for e in page]
         return enrollments
@@ -0,0 +1,132 @@
+"""json encoding and decoding, and timestamp parsing, for the canvas pipeline
+
+every page from canvas is decoded once in lib.canvas and every object
+is serialized once, canonically, to compute its content hash when it's
+staged (canvas.models.canonical_json).  those two calls are most of
+the cpu an ingest spends outside the database, so they go through a
+codec: orjson when it's installed, the standard library json module
+otherwise.  DJANVAS_JSON_CODEC=json (or orjson) picks one explicitly.
+
+both codecs give the same canonical text, byte for byte, so content
+hashes don't change with the codec: sorted keys, no whitespace and
+non-ascii characters kept as they are.  orjson writes very large and
+very small floats differently (1e16 vs 1e+16, 0.00001 vs 1e-05), so
+the rare object that might have one is serialized with the standard
+library instead.
+
+parse_datetime turns canvas's ISO 8601 timestamps into aware datetimes
+ahead of time, so the materializers hand django datetimes rather than
+strings for it to parse field by field.
+"""
+import datetime
+import json
+import os
+import re
+
+import dateutil.parser
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+codec_env_var = "DJANVAS_JSON_CODEC"
+# orjson writes a float differently from json only where its text has
+# an exponent (an "e" then a digit or "-") or a 0.0000.  two searches
+# each starting with a literal are several times faster than one
+# regex with both
+exponent = re.compile(rb"e[-0-9]")
+
+
+class JsonCodec:
+    """ the standard library json module """
+    name = "json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+    def canonical(self, obj):
+        return json.dumps(obj, sort_keys=True, separators=(",", ":"),
+                          ensure_ascii=False)
+
+
+class OrjsonCodec(JsonCodec):
+    """ orjson, falling back to json for what it can't do the same way:
+    integers past 64 bits, non-string keys and very large or small floats """
+    name = "orjson"
+
+    def loads(self, data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            return super().dumps(obj)
+
+    def canonical(self, obj):
+        try:
+            text = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            return super().canonical(obj)
+        if b"0.0000" in text or exponent.search(text):
+            return super().canonical(obj)
+        return text.decode("utf-8")
+
+
+codecs = {"json": JsonCodec}
+if orjson is not None:
+    codecs["orjson"] = OrjsonCodec
+
+
+def get_codec(name=None):
+    """ the codec called name, by default the one DJANVAS_JSON_CODEC
+    names or else the fastest installed """
+    name = name or os.environ.get(codec_env_var) or list(codecs)[-1]
+    if name not in codecs:
+        raise ValueError(f"unknown or uninstalled json codec {name!r}, "
+                         f"have {', '.join(codecs)}")
+    return codecs[name]()
+
+
+codec = get_codec()
+
+
+def use(name):
+    """ switch the codec every loads/dumps/canonical goes through,
+    returns the previous one """
+    global codec
+    previous = codec
+    codec = get_codec(name)
+    return previous
+
+
+def loads(data):
+    return codec.loads(data)
+
+
+def dumps(obj):
+    return codec.dumps(obj)
+
+
+def canonical(obj):
+    return codec.canonical(obj)
+
+
+def parse_datetime(value):
+    """ an aware datetime from a canvas timestamp like 2022-01-10T06:00:00Z,
+    None (or "") is None """
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return dateutil.parser.isoparse(value)
@@ -0,0 +1,80 @@
+"""logging helpers for the canvas client and the sync
+
+RedactTokens scrubs bearer tokens out of every record that reaches a
+handler it's on (see LOGGING in the settings), SampleFilter lets only
+one in every n records of a per-row logger through, and queued() moves
+the handlers of some loggers onto a QueueListener thread for the
+length of a run, so the threads fetching and writing don't wait on
+the terminal.
+"""
+import contextlib
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import re
+
+bearer = re.compile(r"(Bearer\s+)\S+", re.IGNORECASE)
+
+
+def verbosity_level(verbosity):
+    """ the log level for a django -v/--verbosity: 0 warnings, 1 info, 2+ debug """
+    return {0: logging.WARNING, 1: logging.INFO}.get(verbosity, logging.DEBUG)
+
+
+def set_level(level, *names):
+    for name in names:
+        logging.getLogger(name).setLevel(level)
+
+
+class RedactTokens(logging.Filter):
+    """ replaces bearer tokens, and the canvas token itself, with [redacted] """
+    def __init__(self, name="", env_var="DJANVAS_TOKEN"):
+        super().__init__(name)
+        self.env_var = env_var
+
+    def filter(self, record):
+        message = record.getMessage()
+        redacted = bearer.sub(r"\1[redacted]", message)
+        token = os.environ.get(self.env_var)
+        if token:
+            redacted = redacted.replace(token, "[redacted]")
+        if redacted != message:
+            record.msg = redacted
+            record.args = None
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """ lets the first of every `every` records through """
+    def __init__(self, every=1):
+        super().__init__()
+        self.every = max(1, every)
+        self._count = itertools.count()
+
+    def filter(self, record):
+        return next(self._count) % self.every == 0
+
+
+@contextlib.contextmanager
+def queued(*names):
+    """ while active, the named loggers only put their records on a queue;
+    each logger's own handlers run on a listener thread """
+    loggers = [logging.getLogger(name) for name in names]
+    saved = [(logger, logger.handlers) for logger in loggers if logger.handlers]
+    listeners = []
+    for logger, handlers in saved:
+        records = queue.SimpleQueue()
+        listeners.append(logging.handlers.QueueListener(
+            records, *handlers, respect_handler_level=True))
+        logger.handlers = [logging.handlers.QueueHandler(records)]
+    for listener in listeners:
+        listener.start()
+    try:
+        yield
+    finally:
+        for listener in listeners:
+            listener.stop()
+        for logger, logger_handlers in saved:
+            logger.handlers = logger_handlers
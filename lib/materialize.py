@@ -0,0 +1,52 @@
+"""the cpu bound half of materializing enrollments, for worker processes
+
+sync_canvas_data --processes hands the staged enrollment json of a
+pull to a pool of processes a few whole courses at a time.  each
+worker decodes the json, turns it into lib.canvas records, drops what
+the python materializer would drop and sends back plain column tuples,
+which the parent (or its writer threads) upserts.  since a chunk never
+splits a course, deduplicating on (user, course, type) inside a chunk
+is the same as deduplicating over the whole pull.
+
+this module imports nothing from django, so spawned workers start
+quickly and never touch the database.
+"""
+import lib.canvas
+import lib.codec
+
+# set in every worker by init_worker, so they aren't pickled per chunk
+course_ids = frozenset()
+section_ids = frozenset()
+skip_course_ids = frozenset()
+
+
+def init_worker(courses, sections, skipped):
+    global course_ids, section_ids, skip_course_ids
+    course_ids = frozenset(courses)
+    section_ids = frozenset(sections)
+    skip_course_ids = frozenset(skipped)
+
+
+def prepare_enrollments(texts):
+    """ (users, enrollments) for the staged json texts of some whole
+    courses, in staging order: users is {user id: User column tuple} and
+    enrollments a list of Enrollment column tuples, the first of each
+    (user, course, type) """
+    users = {}
+    enrollments = []
+    seen_keys = set()
+    for text in texts:
+        record = lib.canvas.EnrollmentRecord.from_json(lib.codec.loads(text))
+        if (record.course_id in skip_course_ids
+                or record.course_id not in course_ids
+                or record.course_section_id not in section_ids
+                or record.user is None):
+            continue
+        key = record.key
+        if key in seen_keys:
+            continue
+        seen_keys.add(key)
+        if record.user.id not in users:
+            users[record.user.id] = record.user.astuple()
+        enrollments.append(record.astuple())
+    return users, enrollments
@@ -0,0 +1,170 @@
+"""record canvas api responses and play them back without a network
+
+Recorder is a requests response hook that appends every page (url,
+status, body and the Link / rate limit headers) to a gzipped json
+lines archive.  ReplayAdapter is a requests transport adapter that
+answers from such an archive instead of canvas, with a configurable
+latency and, optionally, a simulated leaky bucket that runs dry and
+answers 403 Rate Limit Exceeded like canvas does.  mounted on the
+session of lib.canvas.api it lets the whole sync pipeline run, and be
+benchmarked or profiled, deterministically on a laptop.
+
+    sync_canvas_data --record pull.jsonl.gz        # against canvas
+    sync_canvas_data --replay pull.jsonl.gz        # no token needed
+
+"""
+import datetime
+import gzip
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import lib.codec
+
+recorded_headers = ("Content-Type", "Link", "ETag", "Last-Modified",
+                    "X-Rate-Limit-Remaining", "X-Request-Cost")
+
+
+def archive_key(url, per_page=True):
+    """ urls are matched with their query parameters in sorted order,
+    and without per_page, whatever page size they ask for """
+    parts = urlparse(url)
+    query = urlencode(sorted((name, value) for name, value in parse_qsl(
+        parts.query, keep_blank_values=True) if per_page or name != "per_page"))
+    return urlunparse(parts._replace(query=query))
+
+
+class Recorder:
+    """ appends every response of a session to a gzipped json lines file
+
+        recorder = Recorder("pull.jsonl.gz")
+        session.hooks["response"].append(recorder.hook)
+        ...
+        recorder.close()
+    """
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def hook(self, resp, *args, **kwargs):
+        record = {"url": resp.request.url,
+                  "status": resp.status_code,
+                  "headers": {name: resp.headers[name]
+                              for name in recorded_headers
+                              if name in resp.headers},
+                  "body": resp.text}
+        line = lib.codec.dumps(record)
+        with self._lock:
+            self._file.write(line + "\n")
+            self.count += 1
+        return resp
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def load_archive(path):
+    """ {archive_key(url): record}, later recordings of a url win """
+    records = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            record = lib.codec.loads(line)
+            records[archive_key(record["url"])] = record
+    return records
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    """ a requests transport that serves recorded responses
+
+    latency_ms is added to every request.  with bucket_size set, a
+    leaky bucket like canvas's is simulated: each request costs its
+    recorded X-Request-Cost (or default_cost) plus preflight_cost while
+    in flight, the bucket leaks back at leak_rate units per second,
+    and once it's empty requests get 403 Rate Limit Exceeded.
+    X-Rate-Limit-Remaining then reports the simulated bucket instead
+    of the recorded one.
+
+    lib.canvas.PageSizer picks the per_page of the first page of a query
+    from how fast earlier pages came back, which differs between the
+    recording and the replay.  so a url that wasn't recorded with its
+    per_page is answered with the page recorded with another one; its
+    next links carry the recorded per_page, so the rest of the query is
+    replayed exactly as recorded.  a url that wasn't recorded at all
+    raises LookupError, rather than quietly leaving its pages out.
+    """
+    def __init__(self, path_or_records, latency_ms=0, bucket_size=None,
+                 leak_rate=10, preflight_cost=50, default_cost=1):
+        super().__init__()
+        if isinstance(path_or_records, dict):
+            self.records = path_or_records
+        else:
+            self.records = load_archive(path_or_records)
+        self.any_size = {archive_key(record["url"], per_page=False): record
+                         for record in self.records.values()}
+        self.latency_ms = latency_ms
+        self.bucket_size = bucket_size
+        self.leak_rate = leak_rate
+        self.preflight_cost = preflight_cost
+        self.default_cost = default_cost
+        self.requests = 0
+        self.throttled = 0
+        self._used = 0
+        self._leaked_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _charge(self, cost):
+        """ take cost out of the bucket, False if there isn't enough left """
+        with self._lock:
+            now = time.monotonic()
+            self._used = max(0, self._used - (now - self._leaked_at) * self.leak_rate)
+            self._leaked_at = now
+            if self._used + self.preflight_cost > self.bucket_size:
+                self.throttled += 1
+                return False, 0
+            self._used += cost
+            return True, self.bucket_size - self._used
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self.requests += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        record = (self.records.get(archive_key(request.url))
+                  or self.any_size.get(archive_key(request.url, per_page=False)))
+        if record is None:
+            raise LookupError(f"{request.url} is not in the replayed archive")
+        headers = CaseInsensitiveDict(record["headers"])
+        status = record["status"]
+        body = record["body"]
+        if self.bucket_size is not None:
+            cost = float(headers.get("X-Request-Cost", self.default_cost))
+            allowed, remaining = self._charge(cost)
+            headers["X-Rate-Limit-Remaining"] = str(round(remaining, 3))
+            if not allowed:
+                status = 403
+                body = "403 Forbidden (Rate Limit Exceeded)"
+                headers.pop("Link", None)
+        resp = requests.Response()
+        resp.status_code = status
+        resp.headers = headers
+        resp._content = body.encode("utf-8")
+        resp.encoding = "utf-8"
+        resp.url = request.url
+        resp.request = request
+        resp.reason = "Replayed"
+        resp.elapsed = datetime.timedelta(milliseconds=self.latency_ms)
+        return resp
+
+    def close(self):
+        pass
+
+    def state(self):
+        with self._lock:
+            return {"requests": self.requests, "throttled": self.throttled,
+                    "recorded_urls": len(self.records)}
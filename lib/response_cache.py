@@ -0,0 +1,128 @@
+"""on-disk cache of canvas api pages for conditional requests
+
+every cached page keeps the ETag and Last-Modified canvas sent with
+it.  the next time the same url is asked for, the request carries
+If-None-Match / If-Modified-Since, and a 304 Not Modified answer is
+turned back into the page we already have, so a repeat sync only
+downloads what changed.  the cache is one sqlite file; when it grows
+past max_bytes the least recently used pages are dropped.
+
+urls are the only key, so use one cache file per canvas token.
+
+cf https://developer.mozilla.org/en-US/docs/Web/HTTP/Conditional_requests
+"""
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+default_max_bytes = 256 * 1024 * 1024
+# response headers worth replaying along with a cached body
+cached_headers = ("Content-Type", "Link", "ETag", "Last-Modified")
+
+
+class ResponseCache:
+    """ a size bounded LRU cache of GET responses in a sqlite file """
+    def __init__(self, path, max_bytes=default_max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.stored = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""create table if not exists page (
+                              url text primary key,
+                              etag text,
+                              last_modified text,
+                              headers text not null,
+                              body blob not null,
+                              size integer not null,
+                              last_used real not null)""")
+        self._db.execute("create index if not exists page_last_used "
+                         "on page (last_used)")
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def conditional_headers(self, url):
+        """ the If-None-Match / If-Modified-Since headers for a url,
+        empty if we don't have it """
+        with self._lock:
+            row = self._db.execute(
+                "select etag, last_modified from page where url = ?",
+                (url,)).fetchone()
+        if row is None:
+            return {}
+        etag, last_modified = row
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def cached_response(self, url, not_modified):
+        """ rebuild the cached page for url as a 200 response, keeping the
+        fresh headers (rate limit etc) of the 304 that told us to use it """
+        with self._lock:
+            row = self._db.execute(
+                "select headers, body from page where url = ?",
+                (url,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("update page set last_used = ? where url = ?",
+                             (time.time(), url))
+            self._db.commit()
+            self.hits += 1
+        headers, body = row
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = url
+        resp._content = body
+        resp.headers = CaseInsensitiveDict(not_modified.headers)
+        for line in headers.splitlines():
+            name, _, value = line.partition(": ")
+            resp.headers[name] = value
+        resp.elapsed = not_modified.elapsed
+        resp.request = not_modified.request
+        return resp
+
+    def store(self, url, resp):
+        """ keep a 200 response if canvas gave us something to revalidate
+        it with """
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        if resp.status_code != 200 or not (etag or last_modified):
+            return
+        with self._lock:
+            self.stored += 1
+            headers = "\n".join(f"{name}: {resp.headers[name]}"
+                                for name in cached_headers
+                                if name in resp.headers)
+            body = resp.content
+            self._db.execute(
+                "insert or replace into page values (?, ?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, headers, body, len(body),
+                 time.time()))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total, = self._db.execute(
+            "select coalesce(sum(size), 0) from page").fetchone()
+        while total > self.max_bytes:
+            url, size = self._db.execute(
+                "select url, size from page order by last_used limit 1"
+            ).fetchone()
+            self._db.execute("delete from page where url = ?", (url,))
+            total -= size
+
+    def state(self):
+        with self._lock:
+            pages, size = self._db.execute(
+                "select count(*), coalesce(sum(size), 0) from page").fetchone()
+            return {"pages": pages, "bytes": size,
+                    "hits": self.hits, "stored": self.stored}
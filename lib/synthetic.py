@@ -0,0 +1,187 @@
+"""made up canvas data at any scale, for benchmarking the sync
+
+SyntheticCanvas has the iter_* methods of lib.canvas.api but makes its
+pages up instead of asking canvas, deterministically from a seed, so
+the staging and materialization stages of sync_canvas_data can be
+timed with 100 courses or with 10,000 courses and a million
+enrollments.  users are drawn from a pool smaller than the number of
+enrollments, so like real data most of them are enrolled more than
+once.  write_archive() saves the same pages for sync_canvas_data
+--replay, to benchmark the http side as well.
+"""
+import datetime
+import gzip
+import json
+import random
+import uuid
+
+import lib.canvas
+from lib.replay import archive_key
+
+# canvas ids are shard id * 10**13 + local id
+id_offset = 73770000000000000
+epoch = datetime.datetime(2020, 1, 6, tzinfo=datetime.timezone.utc)
+enrollment_types = [("StudentEnrollment", 20), ("TeacherEnrollment", 1),
+                    ("TaEnrollment", 1)]
+
+
+def isoformat(ts):
+    return ts.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class SyntheticCanvas:
+    """ a stand-in for lib.canvas.api serving made up courses, sections and
+    enrollments
+
+    course i has sections_per_course sections and enrollments_per_course
+    enrollments of users picked from a pool of users (default a tenth of
+    all enrollments)
+    """
+    def __init__(self, courses=100, sections_per_course=2,
+                 enrollments_per_course=30, users=None,
+                 per_page=lib.canvas.max_per_page, seed=0):
+        self.courses = courses
+        self.sections_per_course = sections_per_course
+        self.enrollments_per_course = enrollments_per_course
+        self.users = users or max(1, courses * enrollments_per_course // 10)
+        self.page_size = per_page
+        self.seed = seed
+        # the rest of what the command expects of lib.canvas.api
+        self.throttle = lib.canvas.Throttle()
+        self.sizer = lib.canvas.PageSizer()
+        self.prefetch = 1
+        self.cache = None
+        self.transport = None
+        self.recorder = None
+
+    def course_id(self, i):
+        return id_offset + i + 1
+
+    def course_json(self, i):
+        rng = random.Random(f"{self.seed}:course:{i}")
+        start_at = epoch + datetime.timedelta(weeks=rng.randrange(0, 150))
+        return {"id": self.course_id(i),
+                "name": f"Synthetic Course {i + 1}",
+                "account_id": id_offset + 1 + i % 20,
+                "uuid": str(uuid.UUID(int=rng.getrandbits(128))),
+                "start_at": isoformat(start_at),
+                "end_at": isoformat(start_at + datetime.timedelta(weeks=15)),
+                "created_at": isoformat(start_at - datetime.timedelta(weeks=8)),
+                "course_code": f"SYN {100 + i % 900}",
+                "enrollment_term_id": id_offset + start_at.year,
+                "sis_course_id": None,
+                "workflow_state": "available"}
+
+    def section_json(self, course_id, j):
+        local = course_id - id_offset - 1
+        return {"id": id_offset + local * self.sections_per_course + j + 1,
+                "course_id": course_id,
+                "name": f"Section {j + 1}",
+                "start_at": None,
+                "end_at": None,
+                "created_at": isoformat(epoch),
+                "sis_section_id": None,
+                "sis_course_id": None}
+
+    def user_json(self, k):
+        return {"id": id_offset + k + 1,
+                "name": f"User {k + 1}",
+                "created_at": isoformat(epoch),
+                "sortable_name": f"{k + 1}, User",
+                "short_name": f"User {k + 1}",
+                "sis_user_id": None,
+                "root_account": "canvas.example.edu",
+                "login_id": f"user{k + 1}"}
+
+    def enrollment_json(self, course_id, k):
+        local = course_id - id_offset - 1
+        rng = random.Random(f"{self.seed}:enrollment:{local}:{k}")
+        types, weights = zip(*enrollment_types)
+        enrollment_type = rng.choices(types, weights)[0]
+        user = self.user_json(rng.randrange(self.users))
+        updated_at = epoch + datetime.timedelta(minutes=rng.randrange(0, 10**6))
+        return {"id": id_offset + local * self.enrollments_per_course + k + 1,
+                "user_id": user["id"],
+                "course_id": course_id,
+                "type": enrollment_type,
+                "created_at": isoformat(epoch),
+                "updated_at": isoformat(updated_at),
+                "course_section_id": self.section_json(
+                    course_id, k % self.sections_per_course)["id"]
+                if self.sections_per_course else None,
+                "enrollment_state": "active",
+                "role": enrollment_type,
+                "role_id": id_offset + 3,
+                "last_activity_at": isoformat(updated_at),
+                "last_attended_at": None,
+                "total_activity_time": rng.randrange(0, 10**5),
+                "user": user}
+
+    def _pages(self, url, count, make, start_url):
+        """ yields (page, next_url) like lib.canvas.iter_pages, with
+        numbered page links so resuming from a next_url works """
+        page = lib.canvas.page_number(start_url) or 1
+        while True:
+            first = (page - 1) * self.page_size
+            results = [make(n) for n in
+                       range(first, min(first + self.page_size, count))]
+            more = first + self.page_size < count
+            next_url = f"{url}?per_page={self.page_size}&page={page + 1}" \
+                if more else None
+            yield results, next_url
+            if not more:
+                return
+            page += 1
+
+    def courses_url(self):
+        return f"{lib.canvas.base_url}{lib.canvas.courses_api_path}"
+
+    def iter_all_courses(self, start_url=None):
+        return self._pages(self.courses_url(), self.courses, self.course_json,
+                           start_url)
+
+    def iter_course_sections(self, course_id, start_url=None):
+        return self._pages(f"{self.courses_url()}/{course_id}/sections",
+                           self.sections_per_course,
+                           lambda j: self.section_json(course_id, j),
+                           start_url)
+
+    def iter_course_enrollments(self, course_id, states=None, start_url=None):
+        return self._pages(f"{self.courses_url()}/{course_id}/enrollments",
+                           self.enrollments_per_course,
+                           lambda k: self.enrollment_json(course_id, k),
+                           start_url)
+
+    def iter_urls_and_pages(self):
+        """ yields (url, page, next_url) for every page canvas would serve,
+        the urls being the ones lib.canvas.api asks for """
+        first = f"?per_page={self.page_size}&page=1"
+        def walk(url, pages):
+            for page, next_url in pages:
+                yield url, page, next_url
+                url = next_url
+        yield from walk(self.courses_url() + first, self.iter_all_courses())
+        for i in range(self.courses):
+            course_id = self.course_id(i)
+            yield from walk(f"{self.courses_url()}/{course_id}/sections{first}",
+                            self.iter_course_sections(course_id))
+            yield from walk(f"{self.courses_url()}/{course_id}/enrollments{first}",
+                            self.iter_course_enrollments(course_id))
+
+    def write_archive(self, path):
+        """ save every page as a lib.replay archive, returns the page count
+
+        lib.canvas.api asks for per_page=lib.canvas.max_per_page, so the
+        archive should be made with that page size to be replayed
+        """
+        count = 0
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            for url, page, next_url in self.iter_urls_and_pages():
+                headers = {"Content-Type": "application/json"}
+                if next_url:
+                    headers["Link"] = f'<{next_url}>; rel="next"'
+                f.write(json.dumps({"url": archive_key(url), "status": 200,
+                                    "headers": headers,
+                                    "body": json.dumps(page)}) + "\n")
+                count += 1
+        return count